@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, stream_with_context
+import click
 from markupsafe import Markup
 import os
 import json
@@ -6,7 +7,6 @@ import markdown
 import re
 import datetime
 import requests
-import uuid
 import time
 from dotenv import load_dotenv
 import google.generativeai as genai
@@ -16,16 +16,89 @@ from PIL import Image, ImageDraw
 from io import BytesIO
 import math
 import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from story_store import create_story_store, make_excerpt, story_summary
+from search_index import create_search_index
+from story_ids import new_ulid
+from caching import LRUCache, DiskCache, TieredCache
+import jobs
+from story_stream import StoryStreamParser, sse_event
+from model_registry import ModelRegistry
+from singleflight import SingleFlight
+from resilience import TokenBucket, CircuitBreaker, CircuitOpenError, OutboundCallPolicy, is_retryable
+from text_layout import find_font_path, font_fingerprint, load_font, text_width, line_height, wrap_text, fit_text
+from image_pipeline import ImagePipeline, manifest_paths, find_orphans, select_evictions
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
 
+# Offline stand-in for Gemini (fake_gemini.py), for load tests without an API key or network
+GEMINI_FAKE = os.getenv("GEMINI_FAKE", "").lower() in ("1", "true", "yes")
+
 # Get API keys from environment variables
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or ("fake" if GEMINI_FAKE else None)
 genai.configure(api_key=GEMINI_API_KEY)  # Configure the genai library with API key
 
+if GEMINI_FAKE:
+    from fake_gemini import FakeGenerativeModel, FakeGeminiSettings
+    
+    fake_gemini_settings = FakeGeminiSettings.from_env()
+    model_factory = lambda model_name, generation_config: FakeGenerativeModel(
+        model_name=model_name,
+        generation_config=generation_config,
+        settings=fake_gemini_settings
+    )
+else:
+    model_factory = lambda model_name, generation_config: genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=generation_config
+    )
+
+# Shared model handles, built once per (model name, generation config)
+model_registry = ModelRegistry(model_factory)
+
+# Opt-in cache of model responses keyed by (model, generation config, prompt):
+# an in-memory LRU in front of a size-bounded directory, both with a TTL
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+response_cache = None
+if RESPONSE_CACHE_ENABLED:
+    response_cache = TieredCache(
+        LRUCache(max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "512")), ttl=RESPONSE_CACHE_TTL),
+        DiskCache(
+            os.getenv("RESPONSE_CACHE_DIR", "cache/responses"),
+            max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+            ttl=RESPONSE_CACHE_TTL
+        )
+    )
+
+# All Gemini calls share one rate limiter, deadline/retry policy and circuit breaker
+gemini_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+)
+gemini_policy = OutboundCallPolicy(
+    TokenBucket(
+        rate=max(float(os.getenv("GEMINI_RATE_LIMIT_PER_MINUTE", "60")), 1) / 60,
+        capacity=max(int(os.getenv("GEMINI_RATE_LIMIT_BURST", "10")), 1)
+    ),
+    gemini_breaker,
+    deadline=float(os.getenv("GEMINI_CALL_DEADLINE_SECONDS", "60")),
+    max_attempts=max(int(os.getenv("GEMINI_MAX_ATTEMPTS", "3")), 1)
+)
+
+# Coalesce identical in-flight model calls and panel regenerations
+model_call_flight = SingleFlight()
+regenerate_flight = SingleFlight()
+
 # Directory for storing images
 IMAGES_DIR = "static/images"
 os.makedirs(IMAGES_DIR, exist_ok=True)
@@ -34,25 +107,109 @@ os.makedirs(IMAGES_DIR, exist_ok=True)
 STORIES_DIR = "stories"
 STATIC_IMG_DIR = "static/img/stories"
 
+# Lifetime of responses whose URL never changes meaning (one year)
+IMMUTABLE_MAX_AGE = 31536000
+
+# Story storage backend: "json" (one file per story in STORIES_DIR), "sharded"
+# (STORIES_DIR/<YYYYMM>/<id>.json with per-shard manifests) or "sqlite"
+STORY_STORE = os.getenv("STORY_STORE", "json")
+STORY_DB_PATH = os.getenv("STORY_DB_PATH", "stories.db")
+
+# Full-text search: "fts5" (SQLite FTS5 in SEARCH_DB_PATH) or "memory" (pure Python)
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "fts5")
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", "search.db")
+
+# Number of story cards per page on the homepage and the list API
+STORIES_PAGE_SIZE = int(os.getenv("STORIES_PAGE_SIZE", "12"))
+
 # Create directories if they don't exist
 os.makedirs(STORIES_DIR, exist_ok=True)
 os.makedirs(STATIC_IMG_DIR, exist_ok=True)
 
+# Rendered story HTML/panels, keyed by story id plus a hash of markdown_story.
+# Set RENDER_CACHE_DIR to keep rendered stories on disk across restarts.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "256"))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR")
+render_cache = TieredCache(
+    LRUCache(max_entries=RENDER_CACHE_SIZE),
+    DiskCache(RENDER_CACHE_DIR) if RENDER_CACHE_DIR else None
+)
+
+# Pre-rendered static image layers (speech bubbles, starbursts, silhouettes,
+# caption boxes), built on first use and shared by every render
+layer_cache = LRUCache(max_entries=int(os.getenv("LAYER_CACHE_SIZE", "128")))
+
+# TrueType font for text drawn on generated images; falls back to a bundled
+# system font, then to Pillow's built-in font
+COMIC_FONT_PATH = os.getenv("COMIC_FONT_PATH") or find_font_path()
+
+def get_font(size):
+    """Return the shared comic font at a pixel size"""
+    return load_font(COMIC_FONT_PATH, size)
+
+# Every generated image is written as a progressive JPEG plus WebP/AVIF
+# variants at each of IMAGE_WIDTHS, for responsive <picture> markup. Files are
+# named by a hash of their content, so identical renders are stored once.
+image_pipeline = ImagePipeline(
+    widths=[int(w) for w in os.getenv("IMAGE_WIDTHS", "400,800").split(",") if w.strip()],
+    jpeg_quality=int(os.getenv("IMAGE_JPEG_QUALITY", "85")),
+    webp_quality=int(os.getenv("IMAGE_WEBP_QUALITY", "80")),
+    avif_quality=int(os.getenv("IMAGE_AVIF_QUALITY", "60"))
+)
+
+# Width of the cover thumbnails shown on the story index
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "240"))
+
+# On-demand panel renders (/render/<story_id>/<panel>): bump RENDERER_VERSION
+# whenever the renderer's output changes, so cached copies are not reused.
+# The URL version also changes with the font, which differs between hosts.
+RENDERER_VERSION = "1"
+RENDER_URL_VERSION = f"{RENDERER_VERSION}.{font_fingerprint(COMIC_FONT_PATH)}"
+rendered_panel_cache = LRUCache(max_entries=int(os.getenv("RENDERED_PANEL_CACHE_SIZE", "64")))
+render_flight = SingleFlight()
+
+# Maximum number of images generated at the same time (shared by all requests)
+IMAGE_GENERATION_WORKERS = max(int(os.getenv("IMAGE_GENERATION_WORKERS", "4")), 1)
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_GENERATION_WORKERS, thread_name_prefix="image-gen")
+
+# Background workers for /generate; finished jobs are kept for JOB_TTL_SECONDS.
+# Statuses go to JOB_STATUS_DIR so /jobs/<id> works on every web worker.
+GENERATION_WORKERS = max(int(os.getenv("GENERATION_WORKERS", "2")), 1)
+job_queue = jobs.JobQueue(
+    max_workers=GENERATION_WORKERS,
+    ttl=int(os.getenv("JOB_TTL_SECONDS", "3600")),
+    status_dir=os.getenv("JOB_STATUS_DIR", "cache/jobs")
+)
+# How often /jobs/<id>/stream checks the job for news
+JOB_STREAM_POLL_SECONDS = float(os.getenv("JOB_STREAM_POLL_SECONDS", "0.25"))
+
+# Process-wide story store shared by the views, save_story and regenerate_image
+story_store = create_story_store(
+    STORY_STORE,
+    STORIES_DIR,
+    STORY_DB_PATH,
+    rescan_interval=float(os.getenv("STORY_INDEX_RESCAN_SECONDS", "5"))
+)
+
+# Inverted index over title, prompt and markdown_story, updated on every story write
+search_index = create_search_index(SEARCH_INDEX, SEARCH_DB_PATH, summarize=story_summary)
+search_build_lock = threading.Lock()
+
 # Helper functions
 def get_timestamp():
     """Generate a timestamp for unique file naming"""
     return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
-def save_story(prompt, markdown_story, image_paths=None, image_prompts=None):
-    """Save a story to a JSON file with a unique ID."""
+def save_story(prompt, markdown_story, image_paths=None, image_prompts=None, style="comic book"):
+    """Save a story to the story store with a unique ID."""
     if image_paths is None:
         image_paths = []
     
     if image_prompts is None:
         image_prompts = []
         
-    # Generate a unique ID and timestamp
-    story_id = str(uuid.uuid4())
+    # Generate a unique, time-ordered ID and timestamp
+    story_id = new_ulid()
     created_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
     # Extract title from the markdown (first heading)
@@ -65,17 +222,97 @@ def save_story(prompt, markdown_story, image_paths=None, image_prompts=None):
         "markdown_story": markdown_story,
         "image_paths": image_paths,
         "image_prompts": image_prompts,  # Store the image prompts
+        "style": style,  # Art style for images rendered later
         "created_date": created_date,
-        "title": title
+        "title": title,
+        "excerpt": make_excerpt(markdown_story)  # Precomputed for the story listing
     }
     
-    # Save to a JSON file
-    story_path = os.path.join(STORIES_DIR, f"{story_id}.json")
-    with open(story_path, "w") as f:
-        json.dump(story_data, f, indent=2)
+    # Persist through the configured store
+    write_story(story_data)
     
     return story_data
 
+def attach_image_manifests(story_data):
+    """Record the responsive variants of each story image, keyed by image path"""
+    previous = story_data.get("image_manifests") or {}
+    manifests = {}
+    for path in story_data.get("image_paths", []):
+        if not path:
+            continue
+        manifest = previous.get(path) or image_pipeline.describe(path)
+        if manifest:
+            manifests[path] = manifest
+    story_data["image_manifests"] = manifests
+
+def attach_thumbnail(story_data):
+    """Point the story at a small thumbnail of its cover (image_paths[0])"""
+    image_paths = story_data.get("image_paths") or []
+    # On-demand /render covers have no file to shrink
+    story_data["thumbnail"] = (
+        image_pipeline.make_thumbnail(image_paths[0], THUMBNAIL_WIDTH)
+        if image_paths and image_paths[0] and os.path.isfile(image_paths[0]) else None
+    )
+
+def prepare_story_record(story_data):
+    """Fill in the derived fields every saved story record carries"""
+    attach_image_manifests(story_data)
+    attach_thumbnail(story_data)
+    # Bumped on every write; page ETags are derived from it
+    story_data["version"] = story_data.get("version", 0) + 1
+    story_data["updated_date"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return story_data
+
+def write_story(story_data):
+    """Persist a story record and drop any cached renders of it"""
+    story_store.save(prepare_story_record(story_data))
+    invalidate_story_render(story_data["id"])
+    index_story(story_data)
+    return story_data
+
+def index_story(story_data):
+    """Update the search index for one saved story; a failure here never fails the save"""
+    try:
+        search_index.add(story_data)
+    except Exception as e:
+        print(f"Error indexing story {story_data.get('id')}: {e}")
+        traceback.print_exc()
+
+def ensure_search_index():
+    """Build the search index from the story store the first time it is needed"""
+    if search_index.built:
+        return
+    with search_build_lock:
+        if not search_index.built:
+            search_index.rebuild(story_store.list_all())
+
+def update_story(story_id, change, images=()):
+    """Apply change(story_data) to the latest saved record under the story's lock.
+    
+    Use this instead of get_story + write_story whenever a record is modified,
+    so concurrent updates of one story do not overwrite each other. change
+    runs once, under the lock, so keep it to editing the record. Pass the
+    image paths it adds as images: their manifests are built before the lock
+    is taken. Returns the saved record, or None if the story does not exist.
+    """
+    manifests = {}
+    for path in images:
+        manifest = image_pipeline.describe(path)
+        if manifest:
+            manifests[path] = manifest
+    
+    def apply(story_data):
+        change(story_data)
+        # Images nobody described beforehand (e.g. added by another update) are described here
+        story_data["image_manifests"] = {**(story_data.get("image_manifests") or {}), **manifests}
+        return prepare_story_record(story_data)
+    
+    story_data = story_store.update(story_id, apply)
+    if story_data is not None:
+        invalidate_story_render(story_id)
+        index_story(story_data)
+    return story_data
+
 def extract_title_from_markdown(markdown_text):
     """Extract the title from markdown text (first heading)"""
     lines = markdown_text.split('\n')
@@ -142,98 +379,224 @@ def split_story_by_panels(markdown_story):
     return intro, panels
 
 def load_stories():
-    """Load all stories from the stories directory."""
-    stories = []
-    if os.path.exists(STORIES_DIR):
-        for filename in os.listdir(STORIES_DIR):
-            if filename.endswith(".json"):
-                with open(os.path.join(STORIES_DIR, filename), "r") as f:
-                    story_data = json.load(f)
-                    stories.append(story_data)
-    
-    # Sort stories by creation date (newest first)
-    stories.sort(key=lambda x: x.get("created_date", ""), reverse=True)
-    return stories
-
-def generate_story(prompt, num_panels=4, style="comic book"):
-    """Generate a story using the Gemini API."""
+    """Load all stories from the story store (newest first)."""
+    return story_store.list_all()
+
+def get_story(story_id):
+    """Look up a single story by ID without scanning the stories directory."""
+    return story_store.get(story_id)
+
+def response_cache_key(model_name, generation_config, prompt):
+    """Hash a model call's inputs into a response cache key"""
+    payload = json.dumps([model_name, generation_config or {}, prompt], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(model_name, generation_config, prompt):
+    """Return a cached response text, or None on a miss or when caching is off"""
+    if response_cache is None:
+        return None
+    return response_cache.get(response_cache_key(model_name, generation_config, prompt))
+
+def cache_response(model_name, generation_config, prompt, text):
+    """Remember a response text when caching is on"""
+    if response_cache is not None and text:
+        response_cache.set(response_cache_key(model_name, generation_config, prompt), text)
+
+def generate_text(model_name, generation_config, prompt, bypass_cache=False, store=True):
+    """Call a model and return its response text, going through the response cache.
+    
+    bypass_cache skips the cache lookup (the fresh answer is still stored), for
+    callers that explicitly want a different answer to the same prompt.
+    With store=False the answer is not cached; callers that validate the
+    answer call cache_response themselves once it has passed.
+    Concurrent calls with identical inputs share a single model call.
+    """
+    if not bypass_cache:
+        cached = get_cached_response(model_name, generation_config, prompt)
+        if cached is not None:
+            return cached
+    
+    def call_model():
+        model = model_registry.get(model_name, generation_config)
+        text = gemini_policy.call(
+            lambda timeout: model.generate_content(prompt, request_options={"timeout": timeout}).text
+        )
+        if store:
+            cache_response(model_name, generation_config, prompt, text)
+        return text
+    
+    key = response_cache_key(model_name, generation_config, prompt)
+    return model_call_flight.do(key, call_model)
+
+# Model and settings used for story generation
+STORY_MODEL_NAME = "gemini-1.5-pro"
+STORY_GENERATION_CONFIG = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 2048,
+}
+
+def build_story_prompt(prompt, num_panels=4, style="comic book"):
+    """Build the story generation prompt sent to the model"""
+    story_prompt = f"""
+    You are a creative comic book writer and artist. Create an engaging comic-style story with exactly {num_panels} distinct panels that will be illustrated as a comic book or manga.
+    
+    The story should be based on this prompt: "{prompt}"
+    
+    Format your response in markdown with:
+    1. A creative title (# Title) - make it catchy and comic-like
+    2. An introduction paragraph that sets the scene
+    3. Exactly {num_panels} sections (## Panel 1, ## Panel 2, etc.) - one for each comic panel
+    4. Each panel description should:
+       - Include vivid visual descriptions for the illustrator
+       - Include dialogue in quotation marks ("Like this!")
+       - Describe the scene, characters, actions, and emotions clearly
+       - Focus on a single moment or action that would make a good comic panel
+    5. End with a conclusion paragraph that wraps up the story
+    6. After the conclusion, include a section called "## Image Prompts" that contains {num_panels + 1} distinct prompts for image generation:
+       - First prompt should be for the cover image
+       - Remaining prompts should be for each panel
+       - Format as "Cover: [detailed prompt for cover image]" and "Panel 1: [detailed prompt for panel 1]", etc.
+       - Each image prompt should be descriptive, detailed and optimized for AI image generation
+    
+    Comic-specific guidelines:
+    - Create visually interesting scenes that would work well as comic book panels
+    - Include dynamic camera angles (close-ups, wide shots, etc.) in your descriptions
+    - Use dialogue that fits in speech bubbles - keep it concise and impactful
+    - Use comic book conventions like onomatopoeia (BOOM!, CRASH!) where appropriate
+    - Include character emotions and expressions clearly
+    - Describe the art style as {style}
+    - Keep panels roughly the same length, but vary them for dramatic effect
+    
+    The output will be turned into a {style} comic with {num_panels} illustrated panels, so make sure each section describes a clear, distinct visual scene.
+    """
+    return story_prompt
+
+def parse_story_response(raw_story, prompt, num_panels=4):
+    """Clean up a model response into (markdown_story, image_prompts, used_fallback)"""
+    # Clean up the markdown
+    markdown_story = raw_story.strip()
+    
+    # Extract image prompts (if present)
+    image_prompts = extract_image_prompts(markdown_story)
+    
+    # Remove image prompts section from the story
+    if "## Image Prompts" in markdown_story:
+        markdown_story = markdown_story.split("## Image Prompts")[0].strip()
+    
+    # Ensure we have exactly the right number of section headings
+    section_headings = re.findall(r'## .*', markdown_story)
+    if len(section_headings) != num_panels:
+        # If we don't have the right number of headings, use the fallback
+        markdown_story, image_prompts = fallback_story_generation(prompt, num_panels)
+        return markdown_story, image_prompts, True
+    
+    return markdown_story, image_prompts, False
+
+def generate_story(prompt, num_panels=4, style="comic book", on_stage=None, bypass_cache=False):
+    """Generate a story using the Gemini API.
+    
+    on_stage, if given, is called with the job stage as generation progresses.
+    bypass_cache forces a new model call even if the response cache has an answer.
+    """
+    if on_stage is None:
+        on_stage = lambda stage: None
+    
     try:
         if not GEMINI_API_KEY:
             return fallback_story_generation(prompt, num_panels)
-            
-        # Configure the model
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 2048,
-        }
-        
-        # Create model instance
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
-            generation_config=generation_config
-        )
-        
-        # Create the prompt for story generation
-        story_prompt = f"""
-        You are a creative comic book writer and artist. Create an engaging comic-style story with exactly {num_panels} distinct panels that will be illustrated as a comic book or manga.
-        
-        The story should be based on this prompt: "{prompt}"
-        
-        Format your response in markdown with:
-        1. A creative title (# Title) - make it catchy and comic-like
-        2. An introduction paragraph that sets the scene
-        3. Exactly {num_panels} sections (## Panel 1, ## Panel 2, etc.) - one for each comic panel
-        4. Each panel description should:
-           - Include vivid visual descriptions for the illustrator
-           - Include dialogue in quotation marks ("Like this!")
-           - Describe the scene, characters, actions, and emotions clearly
-           - Focus on a single moment or action that would make a good comic panel
-        5. End with a conclusion paragraph that wraps up the story
-        6. After the conclusion, include a section called "## Image Prompts" that contains {num_panels + 1} distinct prompts for image generation:
-           - First prompt should be for the cover image
-           - Remaining prompts should be for each panel
-           - Format as "Cover: [detailed prompt for cover image]" and "Panel 1: [detailed prompt for panel 1]", etc.
-           - Each image prompt should be descriptive, detailed and optimized for AI image generation
-        
-        Comic-specific guidelines:
-        - Create visually interesting scenes that would work well as comic book panels
-        - Include dynamic camera angles (close-ups, wide shots, etc.) in your descriptions
-        - Use dialogue that fits in speech bubbles - keep it concise and impactful
-        - Use comic book conventions like onomatopoeia (BOOM!, CRASH!) where appropriate
-        - Include character emotions and expressions clearly
-        - Describe the art style as {style}
-        - Keep panels roughly the same length, but vary them for dramatic effect
-        
-        The output will be turned into a {style} comic with {num_panels} illustrated panels, so make sure each section describes a clear, distinct visual scene.
-        """
         
         # Generate the story
-        response = model.generate_content(story_prompt)
-        markdown_story = response.text
-        
-        # Clean up the markdown
-        markdown_story = markdown_story.strip()
-        
-        # Extract image prompts (if present)
-        image_prompts = extract_image_prompts(markdown_story)
-        
-        # Remove image prompts section from the story
-        if "## Image Prompts" in markdown_story:
-            markdown_story = markdown_story.split("## Image Prompts")[0].strip()
-        
-        # Ensure we have exactly the right number of section headings
-        section_headings = re.findall(r'## .*', markdown_story)
-        if len(section_headings) != num_panels:
-            # If we don't have the right number of headings, use the fallback
-            return fallback_story_generation(prompt, num_panels), []
+        on_stage(jobs.STAGE_CALLING_MODEL)
+        story_prompt = build_story_prompt(prompt, num_panels, style)
+        raw_story = generate_text(
+            STORY_MODEL_NAME,
+            STORY_GENERATION_CONFIG,
+            story_prompt,
+            bypass_cache=bypass_cache,
+            store=False
+        )
+        on_stage(jobs.STAGE_PARSING)
         
+        markdown_story, image_prompts, used_fallback = parse_story_response(raw_story, prompt, num_panels)
+        if not used_fallback:
+            # Only answers that parsed are worth serving again
+            cache_response(STORY_MODEL_NAME, STORY_GENERATION_CONFIG, story_prompt, raw_story)
         return markdown_story, image_prompts
+    except CircuitOpenError:
+        print("Gemini circuit is open; using the fallback story")
+        return fallback_story_generation(prompt, num_panels)
     except Exception as e:
         print(f"Error generating story: {e}")
         traceback.print_exc()
-        return fallback_story_generation(prompt, num_panels), []
+        return fallback_story_generation(prompt, num_panels)
+
+def stream_story(prompt, num_panels=4, style="comic book", on_stage=None, on_event=None, bypass_cache=False):
+    """Generate a story with a streaming model call; return (markdown_story, image_prompts).
+    
+    Like generate_story, but title, intro and panels are passed to
+    on_event(event, data) as soon as their markdown is complete, for a live
+    preview. If the streamed answer has to be replaced by the fallback
+    story, a "reset" event comes first.
+    """
+    if on_stage is None:
+        on_stage = lambda stage: None
+    if on_event is None:
+        on_event = lambda event, data: None
+    parser = StoryStreamParser()
+    chunks = []
+    
+    story_prompt = build_story_prompt(prompt, num_panels, style)
+    cached = None if bypass_cache else get_cached_response(STORY_MODEL_NAME, STORY_GENERATION_CONFIG, story_prompt)
+    
+    on_stage(jobs.STAGE_CALLING_MODEL)
+    if cached is not None:
+        chunks.append(cached)
+        for event, data in parser.feed(cached):
+            on_event(event, data)
+    elif GEMINI_API_KEY:
+        try:
+            model = model_registry.get(STORY_MODEL_NAME, STORY_GENERATION_CONFIG)
+            # Retries only cover opening the stream (up to the first chunk)
+            response = gemini_policy.call(
+                lambda timeout: model.generate_content(
+                    story_prompt, stream=True, request_options={"timeout": timeout}
+                )
+            )
+            for chunk in response:
+                chunks.append(chunk.text)
+                for event, data in parser.feed(chunk.text):
+                    on_event(event, data)
+        except CircuitOpenError:
+            print("Gemini circuit is open; using the fallback story")
+        except Exception as e:
+            if is_retryable(e):
+                gemini_breaker.record_failure()
+            print(f"Error streaming story: {e}")
+            traceback.print_exc()
+    
+    on_stage(jobs.STAGE_PARSING)
+    raw_story = "".join(chunks)
+    if raw_story.strip():
+        for event, data in parser.close():
+            on_event(event, data)
+        markdown_story, image_prompts, used_fallback = parse_story_response(raw_story, prompt, num_panels)
+        if not used_fallback and cached is None:
+            cache_response(STORY_MODEL_NAME, STORY_GENERATION_CONFIG, story_prompt, raw_story)
+    else:
+        markdown_story, image_prompts = fallback_story_generation(prompt, num_panels)
+        used_fallback = True
+    
+    if used_fallback:
+        # Replace whatever was previewed with the story that will actually be saved
+        if chunks:
+            on_event("reset", {})
+        fallback_parser = StoryStreamParser()
+        for event, data in fallback_parser.feed(markdown_story) + fallback_parser.close():
+            on_event(event, data)
+    
+    return markdown_story, image_prompts
 
 def extract_image_prompts(markdown_story):
     """Extract image prompts from the markdown story."""
@@ -329,7 +692,35 @@ def fallback_story_generation(prompt, num_panels=4):
     
     return "".join(story_parts), []
 
-def generate_image(prompt, image_path, style="comic book"):
+# Model and settings used to describe images before rendering them
+IMAGE_DESCRIPTION_MODEL_NAME = "gemini-1.5-pro"
+IMAGE_DESCRIPTION_CONFIG = {
+    "temperature": 1.0,
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 4096,
+}
+
+# One request describes the cover and every panel; the response is a JSON list
+IMAGE_DESCRIPTION_BATCH = os.getenv("IMAGE_DESCRIPTION_BATCH", "1").lower() in ("1", "true", "yes")
+IMAGE_BATCH_CONFIG = dict(
+    IMAGE_DESCRIPTION_CONFIG,
+    max_output_tokens=8192,
+    response_mime_type="application/json"
+)
+
+def warm_up_models():
+    """Build the shared model handles and open the API connection ahead of traffic"""
+    model_registry.warm_up(
+        [
+            (STORY_MODEL_NAME, STORY_GENERATION_CONFIG),
+            (IMAGE_DESCRIPTION_MODEL_NAME, IMAGE_DESCRIPTION_CONFIG),
+            (IMAGE_DESCRIPTION_MODEL_NAME, IMAGE_BATCH_CONFIG),
+        ],
+        ping=lambda model: model.count_tokens("ping")
+    )
+
+def generate_image(prompt, image_path, style="comic book", bypass_cache=False, seed=None):
     """Generate an image using Gemini's model for image generation"""
     try:
         if not GEMINI_API_KEY:
@@ -353,34 +744,24 @@ def generate_image(prompt, image_path, style="comic book"):
         """
         
         try:
-            # Use Gemini 1.5 Pro for the detailed description
-            model = genai.GenerativeModel('gemini-1.5-pro')
-            
-            # Configure generation parameters
-            generation_config = {
-                "temperature": 1.0,
-                "top_p": 0.95,
-                "top_k": 64,
-                "max_output_tokens": 4096,
-            }
-            
-            # Generate a detailed text description
-            response = model.generate_content(
+            # Generate a detailed text description with Gemini 1.5 Pro
+            image_description = generate_text(
+                IMAGE_DESCRIPTION_MODEL_NAME,
+                IMAGE_DESCRIPTION_CONFIG,
                 enhanced_prompt,
-                generation_config=generation_config,
-                stream=False
-            )
-            
-            # Get the text description
-            image_description = response.text.strip()
+                bypass_cache=bypass_cache
+            ).strip()
             
             # Now use this detailed description to create an image - this is where you would
             # connect to Imagen or another image generation API. Currently, we'll use our
             # improved placeholder system with the detailed text
             
             print(f"✓ Generated detailed image description: {image_description[:100]}...")
-            return create_art_based_image(image_path, image_description, style)
+            return create_art_based_image(image_path, image_description, style, seed=seed)
             
+        except CircuitOpenError:
+            print("Gemini circuit is open; using a minimal image")
+            return create_minimal_image(image_path, prompt, style)
         except Exception as img_gen_error:
             print(f"Error generating image description: {img_gen_error}")
             traceback.print_exc()
@@ -391,96 +772,97 @@ def generate_image(prompt, image_path, style="comic book"):
         traceback.print_exc()
         return create_minimal_image(image_path, prompt, style)
 
-def create_art_based_image(image_path, description, style="comic book"):
-    """Create an artistic image based on the description"""
+def build_image_batch_prompt(prompts, style="comic book"):
+    """Build one prompt asking for descriptions of several scenes as a JSON list"""
+    scenes = "\n".join(f"{i}. {prompt}" for i, prompt in enumerate(prompts))
+    return f"""
+    Generate a detailed description of a professional-quality {style} illustration for each of these numbered scenes:
+    
+    {scenes}
+    
+    Focus on these elements in each description:
+    - Character appearance details (clothing, expressions, poses)
+    - Scene composition and environment details
+    - Lighting and atmosphere
+    - Color palette
+    - Any text elements like speech bubbles or sound effects
+    
+    Make each description highly specific and detailed enough to create a clear mental image.
+    Respond with only a JSON array containing one object per scene, in order:
+    [{{"id": <scene number>, "description": "<description>"}}]
+    """
+
+def parse_image_batch_response(raw_response, count):
+    """Map scene numbers to descriptions from a batch response.
+    
+    Entries that are missing, malformed or out of range are left out so the
+    caller can describe those scenes individually.
+    """
+    text = raw_response.strip()
+    if text.startswith("```"):
+        text = re.sub(r'^```[a-zA-Z]*\s*|\s*```$', '', text)
     try:
-        # In a real implementation, this would call an image generation API like Stable Diffusion
-        # or Midjourney using the description. For now, we'll create a more sophisticated placeholder.
-        
-        # Create a colored background image
-        width, height = 800, 600
-        
-        # Color scheme based on style and description mood
-        bg_colors = {
-            "comic book": (20, 20, 30),  # Dark blue-black for comic
-            "manga": (10, 10, 15),       # Even darker for manga
-            "pixel art": (25, 35, 40),   # Bluish dark for pixel art
-            "watercolor": (35, 25, 30),  # Reddish dark for watercolor
-            "3D rendered": (25, 15, 35)  # Purplish dark for 3D
-        }
-        
-        # Determine mood from description
-        mood = "standard"
-        if any(word in description.lower() for word in ["dark", "night", "shadow", "gloomy", "mysterious"]):
-            mood = "dark"
-        elif any(word in description.lower() for word in ["bright", "sunny", "vibrant", "colorful", "happy"]):
-            mood = "bright"
-        
-        # Adjust base color based on mood
-        base_color = bg_colors.get(style, (20, 20, 30))
-        if mood == "dark":
-            base_color = (max(base_color[0]-10, 5), max(base_color[1]-10, 5), max(base_color[2]-10, 5))
-        elif mood == "bright":
-            base_color = (min(base_color[0]+10, 40), min(base_color[1]+10, 40), min(base_color[2]+10, 40))
-            
-        # Create the base image
-        image = Image.new('RGB', (width, height), base_color)
-        draw = ImageDraw.Draw(image)
-        
-        # Add a stylish border
-        border_width = 12
-        draw.rectangle(
-            [(border_width, border_width), (width-border_width, height-border_width)],
-            outline=(200, 200, 200),
-            width=border_width//2
+        entries = json.loads(text)
+    except ValueError as e:
+        print(f"Error parsing image description batch: {e}")
+        return {}
+    if isinstance(entries, dict):
+        entries = entries.get("descriptions") or entries.get("scenes") or []
+    if not isinstance(entries, list):
+        return {}
+
+    descriptions = {}
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("id", position)
+        description = entry.get("description")
+        if isinstance(index, str) and index.isdigit():
+            index = int(index)
+        if (isinstance(index, int) and 0 <= index < count
+                and isinstance(description, str) and description.strip()):
+            descriptions.setdefault(index, description.strip())
+    return descriptions
+
+def generate_image_descriptions(prompts, style="comic book", bypass_cache=False):
+    """Describe several scenes with a single model call; return {index: description}"""
+    if not GEMINI_API_KEY or not prompts:
+        return {}
+    try:
+        batch_prompt = build_image_batch_prompt(prompts, style)
+        raw_response = generate_text(
+            IMAGE_DESCRIPTION_MODEL_NAME,
+            IMAGE_BATCH_CONFIG,
+            batch_prompt,
+            bypass_cache=bypass_cache,
+            store=False
         )
+        descriptions = parse_image_batch_response(raw_response, len(prompts))
+        if len(descriptions) == len(prompts):
+            # A cut-off or partial answer would be served again on every retry
+            cache_response(IMAGE_DESCRIPTION_MODEL_NAME, IMAGE_BATCH_CONFIG, batch_prompt, raw_response)
+        print(f"✓ Generated {len(descriptions)}/{len(prompts)} image descriptions in one batch")
+        return descriptions
+    except CircuitOpenError:
+        print("Gemini circuit is open; skipping the image description batch")
+        return {}
+    except Exception as e:
+        print(f"Error generating image description batch: {e}")
+        traceback.print_exc()
+        return {}
+
+def create_art_based_image(image_path, description, style="comic book", seed=None):
+    """Create an artistic image based on the description.
+    
+    With a seed the render is deterministic: the same description, style and
+    seed always produce the same image (and, stored by content, the same file).
+    """
+    try:
+        rng = random.Random(seed) if seed is not None else random
+        image = render_art_image(description, style, rng)
         
-        # Draw artistic panel dividers based on style
-        if style == "comic book":
-            # Create a dynamic panel layout
-            panel_division = random.choice(["diagonal", "horizontal", "vertical", "cross"])
-            
-            if panel_division == "diagonal":
-                draw.line([(border_width*2, border_width*2), (width-border_width*2, height-border_width*2)], 
-                          fill=(150, 150, 150), width=3)
-            elif panel_division == "horizontal":
-                draw.line([(border_width*2, height//2), (width-border_width*2, height//2)], 
-                          fill=(150, 150, 150), width=3)
-            elif panel_division == "vertical":
-                draw.line([(width//2, border_width*2), (width//2, height-border_width*2)], 
-                          fill=(150, 150, 150), width=3)
-            elif panel_division == "cross":
-                draw.line([(width//2, border_width*2), (width//2, height-border_width*2)], 
-                          fill=(150, 150, 150), width=3)
-                draw.line([(border_width*2, height//2), (width-border_width*2, height//2)], 
-                          fill=(150, 150, 150), width=3)
-        
-        # Extract key phrases from the description for visualization
-        key_phrases = extract_key_phrases_from_description(description)
-        
-        # Visualize characters if mentioned
-        character_keywords = extract_character_keywords(description)
-        if character_keywords:
-            draw_character_silhouettes(draw, character_keywords, width, height)
-        
-        # Always add a speech bubble with a key phrase
-        add_artistic_speech_bubble(draw, key_phrases[0] if key_phrases else "...", width, height, style)
-        
-        # Add style-specific visual elements
-        if style == "manga":
-            add_manga_style_elements(draw, width, height, mood)
-        elif style == "comic book":
-            add_comic_style_elements(draw, width, height, mood)
-        elif style == "pixel art":
-            add_pixelated_elements(draw, width, height)
-        
-        # Add scene description at the bottom for context
-        shortened_desc = shorten_description(description, 120)
-        draw_caption_area(draw, shortened_desc, width, height)
-        
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        image.save(image_path)
+        # Write the primary JPEG and its responsive variants, named by content
+        image_path = image_pipeline.save(image, image_path)["src"]
         
         return image_path
     except Exception as e:
@@ -490,6 +872,130 @@ def create_art_based_image(image_path, description, style="comic book"):
         # Fallback to minimal image
         return create_minimal_image(image_path, description, style)
 
+def render_art_image(description, style="comic book", rng=random):
+    """Render the artistic panel for a description and return it as a Pillow image.
+    
+    All randomness comes from rng, so passing random.Random(seed) makes the
+    output reproducible.
+    """
+    # In a real implementation, this would call an image generation API like Stable Diffusion
+    # or Midjourney using the description. For now, we'll create a more sophisticated placeholder.
+    
+    # Create a colored background image
+    width, height = 800, 600
+    
+    # Color scheme based on style and description mood
+    bg_colors = {
+        "comic book": (20, 20, 30),  # Dark blue-black for comic
+        "manga": (10, 10, 15),       # Even darker for manga
+        "pixel art": (25, 35, 40),   # Bluish dark for pixel art
+        "watercolor": (35, 25, 30),  # Reddish dark for watercolor
+        "3D rendered": (25, 15, 35)  # Purplish dark for 3D
+    }
+    
+    # Determine mood from description
+    mood = "standard"
+    if any(word in description.lower() for word in ["dark", "night", "shadow", "gloomy", "mysterious"]):
+        mood = "dark"
+    elif any(word in description.lower() for word in ["bright", "sunny", "vibrant", "colorful", "happy"]):
+        mood = "bright"
+    
+    # Adjust base color based on mood
+    base_color = bg_colors.get(style, (20, 20, 30))
+    if mood == "dark":
+        base_color = (max(base_color[0]-10, 5), max(base_color[1]-10, 5), max(base_color[2]-10, 5))
+    elif mood == "bright":
+        base_color = (min(base_color[0]+10, 40), min(base_color[1]+10, 40), min(base_color[2]+10, 40))
+        
+    # Create the base image
+    image = Image.new('RGB', (width, height), base_color)
+    draw = ImageDraw.Draw(image)
+    
+    # Add a stylish border
+    border_width = 12
+    draw.rectangle(
+        [(border_width, border_width), (width-border_width, height-border_width)],
+        outline=(200, 200, 200),
+        width=border_width//2
+    )
+    
+    # Draw artistic panel dividers based on style
+    if style == "comic book":
+        # Create a dynamic panel layout
+        panel_division = rng.choice(["diagonal", "horizontal", "vertical", "cross"])
+        
+        if panel_division == "diagonal":
+            draw.line([(border_width*2, border_width*2), (width-border_width*2, height-border_width*2)], 
+                      fill=(150, 150, 150), width=3)
+        elif panel_division == "horizontal":
+            draw.line([(border_width*2, height//2), (width-border_width*2, height//2)], 
+                      fill=(150, 150, 150), width=3)
+        elif panel_division == "vertical":
+            draw.line([(width//2, border_width*2), (width//2, height-border_width*2)], 
+                      fill=(150, 150, 150), width=3)
+        elif panel_division == "cross":
+            draw.line([(width//2, border_width*2), (width//2, height-border_width*2)], 
+                      fill=(150, 150, 150), width=3)
+            draw.line([(border_width*2, height//2), (width-border_width*2, height//2)], 
+                      fill=(150, 150, 150), width=3)
+    
+    # Extract key phrases from the description for visualization
+    key_phrases = extract_key_phrases_from_description(description)
+    
+    # Visualize characters if mentioned
+    character_keywords = extract_character_keywords(description)
+    if character_keywords:
+        draw_character_silhouettes(image, character_keywords, width, height)
+    
+    # Always add a speech bubble with a key phrase
+    add_artistic_speech_bubble(image, draw, key_phrases[0] if key_phrases else "...", width, height, style)
+    
+    # Add style-specific visual elements
+    if style == "manga":
+        add_manga_style_elements(draw, width, height, mood, rng)
+    elif style == "comic book":
+        add_comic_style_elements(image, draw, width, height, mood, rng)
+    elif style == "pixel art":
+        add_pixelated_elements(draw, width, height, rng)
+    
+    # Add scene description at the bottom for context
+    shortened_desc = shorten_description(description, 120)
+    draw_caption_area(image, draw, shortened_desc, width, height)
+    
+    return image
+
+def get_cached_layer(key, build):
+    """Return the pre-rendered layer for key, building and caching it on first use.
+    
+    Cached layers are shared between threads and must not be modified.
+    """
+    layer = layer_cache.get(key)
+    if layer is None:
+        layer = build()
+        layer_cache.set(key, layer)
+    return layer
+
+def build_overlay_layer(width, height, paint):
+    """Render paint(draw) on a transparent canvas and crop it to what was drawn.
+    
+    Returns (pixels, mask, offset) for paste_layer, or None if nothing was
+    drawn. Shapes are drawn without anti-aliasing, so a 1-bit mask is exact
+    and pastes much faster than an alpha channel.
+    """
+    canvas = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    paint(ImageDraw.Draw(canvas))
+    alpha = canvas.getchannel('A')
+    bbox = alpha.getbbox()
+    if not bbox:
+        return None
+    return canvas.crop(bbox).convert('RGB'), alpha.crop(bbox).convert('1'), bbox[:2]
+
+def paste_layer(image, layer):
+    """Composite a layer from build_overlay_layer onto an image"""
+    if layer is not None:
+        pixels, mask, offset = layer
+        image.paste(pixels, offset, mask)
+
 def extract_character_keywords(description):
     """Extract character-related words from description"""
     character_indicators = [
@@ -512,7 +1018,21 @@ def extract_character_keywords(description):
     
     return character_words[:3]  # Limit to top 3
 
-def draw_character_silhouettes(draw, character_keywords, width, height):
+def draw_character_silhouettes(image, character_keywords, width, height):
+    """Paste cached character silhouettes matching the keywords"""
+    # The silhouettes only depend on how many characters there are and their type
+    key = (
+        "silhouettes", width, height,
+        min(len(character_keywords), 3),
+        any(word in character_keywords for word in ("child", "boy", "girl")),
+        any(word in character_keywords for word in ("woman", "girl"))
+    )
+    paste_layer(image, get_cached_layer(key, lambda: build_overlay_layer(
+        width, height,
+        lambda draw: paint_character_silhouettes(draw, character_keywords, width, height)
+    )))
+
+def paint_character_silhouettes(draw, character_keywords, width, height):
     """Draw abstract character silhouettes based on keywords"""
     num_characters = min(len(character_keywords), 3)
     character_spacing = width // (num_characters + 1)
@@ -546,20 +1066,37 @@ def draw_character_silhouettes(draw, character_keywords, width, height):
                          (x_pos+45, base_y), (x_pos-45, base_y)], 
                          fill=(120, 120, 140), outline=(160, 160, 180))
 
-def add_artistic_speech_bubble(draw, text, width, height, style):
+def add_artistic_speech_bubble(image, draw, text, width, height, style):
     """Add an artistic speech bubble with stylized text"""
-    # Prepare text
-    if len(text) > 80:
-        text = text[:77] + "..."
+    # Bubble shapes come from the layer cache; only the text is drawn per image
+    bubble_x = width // 3
+    bubble_y = height // 3
+    bubble_width = width // 2
+    bubble_height = 80
+    bubble_shape = "angular" if style == "manga" else "rounded"
+    paste_layer(image, get_cached_layer(
+        ("speech-bubble", width, height, bubble_shape),
+        lambda: build_overlay_layer(width, height, lambda bubble_draw: paint_speech_bubble(
+            bubble_draw, bubble_x, bubble_y, bubble_width, bubble_height, bubble_shape
+        ))
+    ))
     
-    # Different bubble styles based on comic style
-    if style == "manga":
-        # Angular manga-style bubble
-        bubble_x = width // 3
-        bubble_y = height // 3
-        bubble_width = width // 2
-        bubble_height = 80
-        
+    # Wrap the text to the bubble and center the block inside it
+    font = get_font(16)
+    lines = fit_text(text, font, bubble_width - 30, max_lines=3)
+    spacing = line_height(font)
+    text_y = bubble_y + (bubble_height - spacing * len(lines)) // 2
+    
+    for line in lines:
+        text_x = bubble_x + (bubble_width - text_width(font, line)) // 2
+        # Draw with shadow for better visibility
+        draw.text((text_x+1, text_y+1), line, fill=(50, 50, 50), font=font)
+        draw.text((text_x, text_y), line, fill=(0, 0, 0), font=font)
+        text_y += spacing
+
+def paint_speech_bubble(draw, bubble_x, bubble_y, bubble_width, bubble_height, shape):
+    """Draw an empty speech bubble: angular (manga) or rounded (comic)"""
+    if shape == "angular":
         # Angular points for manga style
         points = [
             (bubble_x, bubble_y),
@@ -573,12 +1110,6 @@ def add_artistic_speech_bubble(draw, text, width, height, style):
         
         draw.polygon(points, fill=(240, 240, 240), outline=(30, 30, 30), width=2)
     else:
-        # Rounded comic-style bubble
-        bubble_x = width // 3
-        bubble_y = height // 3
-        bubble_width = width // 2
-        bubble_height = 80
-        
         # Draw rounded rectangle
         draw.rounded_rectangle(
             [(bubble_x, bubble_y), (bubble_x + bubble_width, bubble_y + bubble_height)],
@@ -592,26 +1123,17 @@ def add_artistic_speech_bubble(draw, text, width, height, style):
              (bubble_x + bubble_width//2 + 15, bubble_y + bubble_height)],
             fill=(240, 240, 240), outline=(30, 30, 30), width=2
         )
-    
-    # Draw text centered in bubble
-    text_width = len(text) * 6  # Rough estimate
-    text_x = bubble_x + bubble_width//2 - text_width//2
-    text_y = bubble_y + bubble_height//2 - 10
-    
-    # Draw with shadow for better visibility
-    draw.text((text_x+1, text_y+1), text, fill=(50, 50, 50))
-    draw.text((text_x, text_y), text, fill=(0, 0, 0))
 
-def add_manga_style_elements(draw, width, height, mood):
+def add_manga_style_elements(draw, width, height, mood, rng=random):
     """Add manga-specific visual elements"""
     # Add speed/emotion lines based on mood
     if mood == "dark":
         # Dark mood - fewer, more angular lines
         for i in range(15):
-            start_x = random.randint(width//4, width*3//4)
-            start_y = random.randint(height//4, height*3//4)
-            length = random.randint(30, 100)
-            angle = random.uniform(0, 2 * 3.14159)
+            start_x = rng.randint(width//4, width*3//4)
+            start_y = rng.randint(height//4, height*3//4)
+            length = rng.randint(30, 100)
+            angle = rng.uniform(0, 2 * 3.14159)
             end_x = start_x + int(length * math.cos(angle))
             end_y = start_y + int(length * math.sin(angle))
             draw.line([(start_x, start_y), (end_x, end_y)], fill=(180, 180, 180), width=1)
@@ -621,35 +1143,22 @@ def add_manga_style_elements(draw, width, height, mood):
         center_y = height // 2
         for i in range(24):
             angle = (i / 24) * 2 * 3.14159
-            length = random.randint(50, 150)
+            length = rng.randint(50, 150)
             end_x = center_x + int(length * math.cos(angle))
             end_y = center_y + int(length * math.sin(angle))
             draw.line([(center_x, center_y), (end_x, end_y)], fill=(200, 200, 200), width=1)
 
-def add_comic_style_elements(draw, width, height, mood):
+def add_comic_style_elements(image, draw, width, height, mood, rng=random):
     """Add comic book-specific visual elements"""
     # Add sound effect burst
-    if random.random() > 0.5:
+    if rng.random() > 0.5:
         sound_effects = ["POW!", "BAM!", "ZOOM!", "WHAM!", "CRASH!", "BANG!"]
-        effect = random.choice(sound_effects)
+        effect = rng.choice(sound_effects)
         
         # Position in upper corner
         effect_x = width * 0.75
         effect_y = height * 0.25
         
-        # Create starburst shape
-        points = []
-        num_points = 12
-        inner_radius = 50
-        outer_radius = 80
-        
-        for i in range(num_points * 2):
-            angle = (i * 3.14159) / num_points
-            radius = outer_radius if i % 2 == 0 else inner_radius
-            x = effect_x + radius * math.cos(angle)
-            y = effect_y + radius * math.sin(angle)
-            points.append((x, y))
-        
         # Color varies by mood
         if mood == "dark":
             fill_color = (80, 20, 20)  # Dark red for dark mood
@@ -660,27 +1169,76 @@ def add_comic_style_elements(draw, width, height, mood):
         else:
             fill_color = (255, 150, 0)  # Orange for standard
             text_color = (0, 0, 0)
-            
-        draw.polygon(points, fill=fill_color, outline=(0, 0, 0), width=2)
         
-        # Draw effect text
-        text_width = len(effect) * 10
-        draw.text((effect_x - text_width//2, effect_y - 15), effect, fill=text_color)
+        paste_layer(image, get_cached_layer(
+            ("starburst", width, height, fill_color),
+            lambda: build_overlay_layer(
+                width, height, lambda burst_draw: paint_starburst(burst_draw, effect_x, effect_y, fill_color)
+            )
+        ))
+        
+        # Draw effect text centered in the burst
+        font = get_font(28)
+        left, top, right, bottom = font.getbbox(effect)
+        draw.text(
+            (effect_x - (left + right) / 2, effect_y - (top + bottom) / 2),
+            effect, fill=text_color, font=font
+        )
+
+def paint_starburst(draw, effect_x, effect_y, fill_color):
+    """Draw the sound-effect starburst centred on (effect_x, effect_y)"""
+    # Create starburst shape
+    points = []
+    num_points = 12
+    inner_radius = 50
+    outer_radius = 80
+    
+    for i in range(num_points * 2):
+        angle = (i * 3.14159) / num_points
+        radius = outer_radius if i % 2 == 0 else inner_radius
+        x = effect_x + radius * math.cos(angle)
+        y = effect_y + radius * math.sin(angle)
+        points.append((x, y))
+    
+    draw.polygon(points, fill=fill_color, outline=(0, 0, 0), width=2)
 
-def add_pixelated_elements(draw, width, height):
+def add_pixelated_elements(draw, width, height, rng=random):
     """Add pixel art style elements"""
     pixel_size = 15
+    if np is not None:
+        add_pixelated_elements_numpy(draw, width, height, pixel_size, rng)
+        return
+    
     # Create a pixelated grid in the background
     for x in range(0, width, pixel_size):
         for y in range(0, height, pixel_size):
-            if random.random() > 0.85:  # Only color some pixels
+            if rng.random() > 0.85:  # Only color some pixels
                 color = (
-                    random.randint(30, 80),
-                    random.randint(30, 80),
-                    random.randint(40, 100)
+                    rng.randint(30, 80),
+                    rng.randint(30, 80),
+                    rng.randint(40, 100)
                 )
                 draw.rectangle([(x, y), (x+pixel_size-1, y+pixel_size-1)], fill=color)
 
+def add_pixelated_elements_numpy(draw, width, height, pixel_size, rng=random):
+    """Pixel grid with the cell choice and colors generated as arrays in one pass.
+    
+    Only the chosen cells (about 15%) are visited in Python. The NumPy
+    generator is seeded from rng, so seeding rng also fixes this layer.
+    """
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    cols = -(-width // pixel_size)
+    rows = -(-height // pixel_size)
+    
+    colors = np.empty((rows, cols, 3), dtype=np.uint8)
+    colors[..., :2] = np_rng.integers(30, 80, (rows, cols, 2), endpoint=True)
+    colors[..., 2] = np_rng.integers(40, 100, (rows, cols), endpoint=True)
+    mask = np_rng.random((rows, cols)) > 0.85  # Only color some pixels
+    
+    ys, xs = np.nonzero(mask)
+    for y, x, color in zip((ys * pixel_size).tolist(), (xs * pixel_size).tolist(), colors[mask].tolist()):
+        draw.rectangle([(x, y), (x+pixel_size-1, y+pixel_size-1)], fill=tuple(color))
+
 def extract_key_phrases_from_description(description, max_phrases=3):
     """Extract key descriptive phrases from the image description"""
     # Split into sentences
@@ -737,41 +1295,30 @@ def shorten_description(description, max_length=120):
         
     return result.strip()
 
-def draw_caption_area(draw, text, width, height):
+def draw_caption_area(image, draw, text, width, height):
     """Draw a caption area at the bottom with the description"""
-    # Create semi-transparent overlay at the bottom
     caption_height = 60
     caption_y = height - caption_height - 10
     
-    # Draw caption background
-    draw.rectangle(
-        [(20, caption_y), (width-20, caption_y + caption_height)],
-        fill=(30, 30, 40, 180),
-        outline=(200, 200, 200),
-        width=1
-    )
+    # Caption background from the layer cache
+    paste_layer(image, get_cached_layer(
+        ("caption-box", width, height),
+        lambda: build_overlay_layer(width, height, lambda box_draw: box_draw.rectangle(
+            [(20, caption_y), (width-20, caption_y + caption_height)],
+            fill=(30, 30, 40),
+            outline=(200, 200, 200),
+            width=1
+        ))
+    ))
     
-    # Wrap text to fit the caption area
-    wrapped_text = []
-    words = text.split()
-    line = ""
-    for word in words:
-        test_line = line + word + " "
-        if len(test_line) * 6 < width - 60:  # Rough estimate
-            line = test_line
-        else:
-            wrapped_text.append(line)
-            line = word + " "
-    if line:
-        wrapped_text.append(line)
-        
-    # Limit to 2 lines maximum
-    wrapped_text = wrapped_text[:2]
+    # Wrap text to fit the caption area, 2 lines maximum
+    font = get_font(15)
+    wrapped_text = fit_text(text, font, width - 60, max_lines=2)
     
     # Draw text
     text_y = caption_y + 10
     for line in wrapped_text:
-        draw.text((30, text_y), line, fill=(220, 220, 220))
+        draw.text((30, text_y), line, fill=(220, 220, 220), font=font)
         text_y += 25
 
 def generate_comic_images(story_id, image_prompts, style="comic book"):
@@ -792,24 +1339,26 @@ def generate_comic_images(story_id, image_prompts, style="comic book"):
         if not cover_prompt:
             cover_prompt = f"Create a captivating comic book cover illustration in {style} style."
         
-        # Generate cover image
-        cover_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_cover.jpg"
-        cover_result = generate_image(cover_prompt, cover_path, style)
-        
-        if cover_result:
-            image_paths.append(cover_result)
+        # Cover image first, then panels
+        image_jobs = [(cover_prompt, f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_cover.jpg")]
         
         # Sort panel prompts by panel number
         panel_prompts = sorted([p for p in image_prompts if p["type"] == "panel"], 
                                key=lambda x: x.get("number", 999))
         
-        # Generate panel images
         for i, panel_prompt in enumerate(panel_prompts, 1):
-            panel_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_panel{i}.jpg"
-            panel_result = generate_image(panel_prompt["prompt"], panel_path, style)
-            
-            if panel_result:
-                image_paths.append(panel_result)
+            image_jobs.append((panel_prompt["prompt"], f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_panel{i}.jpg"))
+        
+        # Describe every image in one request; scenes missing from the batch
+        # response are described individually
+        descriptions = {}
+        if IMAGE_DESCRIPTION_BATCH and len(image_jobs) > 1:
+            descriptions = generate_image_descriptions([prompt for prompt, _ in image_jobs], style)
+        
+        # Generate all images concurrently; results come back in job order
+        # A failed image keeps its slot as None, so later panels stay at their index
+        for result in generate_images_concurrently(image_jobs, style, descriptions, story_id=story_id):
+            image_paths.append(result or None)
     
     except Exception as e:
         print(f"Error in generate_comic_images: {e}")
@@ -817,33 +1366,41 @@ def generate_comic_images(story_id, image_prompts, style="comic book"):
     
     return image_paths
 
-def generate_basic_placeholder_images(story_id, style="comic book"):
-    """Generate basic placeholder images when no prompts are available."""
-    image_paths = []
-    timestamp = get_timestamp()
-    
+def generate_image_safely(prompt, image_path, style="comic book", seed=None):
+    """Generate one image, falling back to a minimal image if anything goes wrong"""
     try:
-        # Create a basic cover
-        cover_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_cover.jpg"
-        cover_prompt = f"Create a captivating comic book cover illustration in {style} style."
-        cover_result = create_placeholder_image(cover_path, cover_prompt)
-        
-        if cover_result:
-            image_paths.append(cover_result)
-        
-        # Create 4 basic panel images
-        for i in range(1, 5):
-            panel_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_panel{i}.jpg"
-            panel_prompt = f"Comic panel {i} in {style} style."
-            panel_result = create_placeholder_image(panel_path, panel_prompt)
-            
-            if panel_result:
-                image_paths.append(panel_result)
-    
+        return generate_image(prompt, image_path, style, seed=seed)
     except Exception as e:
-        print(f"Error in generate_basic_placeholder_images: {e}")
+        print(f"Error generating image {image_path}: {e}")
+        traceback.print_exc()
+        return create_minimal_image(image_path, prompt, style)
+
+def generate_images_concurrently(image_jobs, style="comic book", descriptions=None, story_id=None):
+    """Generate images for (prompt, image_path) pairs on the shared image pool.
     
-    return image_paths
+    Jobs whose index is in descriptions are rendered from that description
+    without another model call. With a story_id each render is seeded from
+    the story, job index and prompt. At most IMAGE_GENERATION_WORKERS images
+    are in flight at once, and results are returned in the same order as
+    image_jobs.
+    """
+    descriptions = descriptions or {}
+    futures = []
+    for i, (prompt, image_path) in enumerate(image_jobs):
+        seed = panel_seed(story_id, i, prompt) if story_id else None
+        if i in descriptions:
+            futures.append(image_executor.submit(create_art_based_image, image_path, descriptions[i], style, seed))
+        else:
+            futures.append(image_executor.submit(generate_image_safely, prompt, image_path, style, seed))
+    return [future.result() for future in futures]
+
+def generate_basic_placeholder_images(story_id, style="comic book"):
+    """Placeholder cover and 4 panels when no prompts are available.
+    
+    These are /render URLs rather than files: the images are drawn on demand
+    from the stored story, so they take no disk space.
+    """
+    return [render_url(story_id, panel_idx) for panel_idx in range(5)]
 
 # Convert markdown to HTML
 def markdown_to_html(markdown_text):
@@ -851,12 +1408,168 @@ def markdown_to_html(markdown_text):
     html = markdown.markdown(markdown_text)
     return html
 
+SOUND_EFFECTS = ['CRASH!', 'BOOM!', 'BAM!', 'POW!', 'BANG!', 'WHAM!']
+
+def build_story_render(markdown_story):
+    """Render everything story.html needs from the markdown in one pass"""
+    intro, panels = split_by_panels_filter(markdown_story)
+    
+    rendered_panels = []
+    for panel in panels:
+        content = ' '.join(panel).replace(panel[0], '').strip()
+        rendered_panel = {
+            "title": panel[0].replace('## ', ''),
+            "content": content.replace('**Visual Description:**', '').replace('**Dialogue:**', ''),
+            "dialogue": None,
+            "sound_effects": []
+        }
+        if '**Dialogue:**' in content:
+            dialogue = content.split('**Dialogue:**')[1].strip()
+            rendered_panel["dialogue"] = dialogue
+            rendered_panel["sound_effects"] = [effect for effect in SOUND_EFFECTS if effect in dialogue]
+        rendered_panels.append(rendered_panel)
+    
+    # The last paragraph doubles as the conclusion unless it is a panel heading
+    conclusion = markdown_story.split('\n\n')[-1].strip()
+    if conclusion.startswith('## '):
+        conclusion = ""
+    
+    return {
+        "html": markdown_to_html(markdown_story),
+        "intro": ' '.join(intro),
+        "panels": rendered_panels,
+        "conclusion": conclusion
+    }
+
+def render_cache_key(story_id, markdown_story):
+    """Cache key for a story render: story id plus a hash of its markdown"""
+    digest = hashlib.sha256(markdown_story.encode("utf-8")).hexdigest()
+    return f"{story_id}-{digest}"
+
+def get_story_render(story_data):
+    """Return the cached render for a story, building it on a miss"""
+    key = render_cache_key(story_data["id"], story_data["markdown_story"])
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = build_story_render(story_data["markdown_story"])
+        render_cache.set(key, rendered)
+    return rendered
+
+def invalidate_story_render(story_id):
+    """Drop all cached renders for a story"""
+    render_cache.delete_prefix(f"{story_id}-")
+
+def template_version(template_dir="templates"):
+    """Fingerprint of the templates' contents, so page ETags change when a deploy changes markup.
+    
+    Contents rather than mtimes, so every host serving the same release agrees.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(template_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, template_dir).encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+TEMPLATE_VERSION = template_version(os.path.join(app.root_path, "templates"))
+
+def page_etag(*parts):
+    """Strong ETag for a rendered page or JSON response built from the given inputs"""
+    key = "\0".join(str(part) for part in (TEMPLATE_VERSION, datetime.datetime.now().year) + parts)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+def story_etag(story_data):
+    """ETag of a story page: its record version, or its content for records saved before versions"""
+    if "version" in story_data:
+        return page_etag(story_data["id"], story_data["version"])
+    content = json.dumps(story_data, sort_keys=True)
+    return page_etag(story_data["id"], hashlib.sha256(content.encode("utf-8")).hexdigest())
+
+def story_last_modified(story_data):
+    """When a story record last changed, as an aware datetime, or None"""
+    stamp = story_data.get("updated_date") or story_data.get("created_date")
+    try:
+        return datetime.datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S").astimezone(datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response when the request's validators match, else None.
+    
+    Views call this before any rendering work so revalidation stays cheap.
+    """
+    if request.if_none_match:
+        # If-None-Match uses weak comparison (RFC 9110 13.1.2): proxies may weaken ETags
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        fresh = bool(last_modified and since and last_modified.replace(microsecond=0) <= since)
+    if not fresh:
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+def with_validators(response, etag, last_modified=None):
+    """Attach an ETag (and Last-Modified) and require revalidation before reuse"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def seed_story_id(story_data):
+    """ID panel seeds derive from; stories moved to the sharded layout keep their old one"""
+    return story_data.get("legacy_id", story_data["id"])
+
+def panel_seed(story_id, panel_idx, prompt, nonce=None):
+    """Deterministic render seed for one panel of a story; a nonce picks a different take"""
+    key = f"{story_id}\0{panel_idx}\0{prompt}" + (f"\0{nonce}" if nonce else "")
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+def render_url(story_id, panel_idx):
+    """URL of the on-demand render of a panel; versioned so browsers may cache it forever"""
+    return f"/render/{story_id}/{panel_idx}?v={RENDER_URL_VERSION}"
+
+def render_etag(story_id, panel_idx, prompt, style):
+    """Strong ETag covering everything that changes a rendered panel"""
+    key = f"{RENDER_URL_VERSION}\0{story_id}\0{panel_idx}\0{style}\0{prompt}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+def render_panel_bytes(story_id, panel_idx, prompt, style):
+    """Render a panel deterministically and encode it as a JPEG"""
+    image = render_art_image(prompt, style, random.Random(panel_seed(story_id, panel_idx, prompt)))
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=image_pipeline.quality["image/jpeg"], progressive=True, optimize=True)
+    return buffer.getvalue()
+
 # Add custom filters
 @app.template_filter('startswith')
 def startswith_filter(s, substring):
     """Check if a string starts with a given substring."""
     return s.startswith(substring)
 
+@app.template_filter('image_url')
+def image_url_filter(path):
+    """Turn a stored image path (static/... or a /render URL) into its URL"""
+    if path.startswith("/"):
+        return path
+    if path.startswith("static/"):
+        return url_for("static", filename=path[len("static/"):])
+    return "/" + path
+
+@app.template_filter('image_available')
+def image_available_filter(path, manifests=None):
+    """True if a stored image path can actually be shown: it has a manifest,
+    is an on-demand /render URL, or its file exists"""
+    if not path:
+        return False
+    if manifests and manifests.get(path):
+        return True
+    return path.startswith("/render/") or os.path.isfile(path)
+
 # Add context processor for current year
 @app.context_processor
 def inject_current_year():
@@ -864,55 +1577,243 @@ def inject_current_year():
 
 @app.route('/')
 def index():
-    """Render the main page"""
-    stories = load_stories()
+    """Render the main page with the first page of story summaries"""
+    stories, next_cursor = story_store.list_summaries(STORIES_PAGE_SIZE)
+    
+    # The first page changes when a story is added or a listed one is updated
+    etag = page_etag("index", json.dumps(stories, sort_keys=True), next_cursor)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
     current_year = datetime.datetime.now().year
-    return render_template('index.html', stories=stories, current_year=current_year)
+    html = render_template('index.html', stories=stories, next_cursor=next_cursor, current_year=current_year)
+    return with_validators(Response(html, mimetype="text/html"), etag)
+
+@app.route('/api/stories')
+def api_stories():
+    """Return one page of story summaries for infinite scroll"""
+    cursor = request.args.get('cursor') or None
+    limit = min(max(request.args.get('limit', STORIES_PAGE_SIZE, type=int), 1), 100)
+    
+    try:
+        stories, next_cursor = story_store.list_summaries(limit, cursor)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid cursor"}), 400
+    
+    etag = page_etag("api-stories", json.dumps(stories, sort_keys=True), next_cursor)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    stories = [summary_json(summary) for summary in stories]
+    return with_validators(jsonify({"success": True, "stories": stories, "next_cursor": next_cursor}), etag)
+
+def summary_json(summary):
+    """A story summary plus the URLs the story cards need"""
+    return dict(
+        summary,
+        url=url_for("story", story_id=summary["id"]),
+        thumbnail_url=image_url_filter(summary["thumbnail"]) if summary.get("thumbnail") else None
+    )
+
+@app.route('/search')
+def search():
+    """Full-text search over stories, best BM25 match first"""
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', STORIES_PAGE_SIZE, type=int), 1), 100)
+    
+    try:
+        ensure_search_index()
+        stories, total = search_index.search(query, limit, (page - 1) * limit)
+    except Exception as e:
+        print(f"Error searching stories: {e}")
+        traceback.print_exc()
+        return jsonify({"success": False, "error": "Search failed"}), 500
+    
+    return jsonify({
+        "success": True,
+        "query": query,
+        "page": page,
+        "total": total,
+        "stories": [summary_json(summary) for summary in stories],
+        "next_page": page + 1 if page * limit < total else None
+    })
+
+def run_generation_job(report_stage, prompt, num_panels, style, bypass_cache=False, preview=False):
+    """Background job: generate a story and persist it (without images).
+    
+    With preview the model answer is streamed and each finished part is
+    published as a job event, for /jobs/<id>/stream.
+    """
+    if preview:
+        markdown_story, _ = stream_story(
+            prompt, num_panels, style,
+            on_stage=report_stage, on_event=report_stage.event, bypass_cache=bypass_cache
+        )
+    else:
+        markdown_story, _ = generate_story(prompt, num_panels, style, on_stage=report_stage, bypass_cache=bypass_cache)
+    
+    report_stage(jobs.STAGE_SAVING)
+    story_data = save_story(prompt, markdown_story, [], [], style)
+    return {"story_id": story_data["id"]}
 
 @app.route('/generate', methods=['POST'])
 def generate():
-    """Generate a new story based on prompt, without images"""
+    """Queue generation of a new story and return the job ID right away"""
     prompt = request.form.get('prompt', 'Generate a short fantasy story')
     num_panels = int(request.form.get('num_panels', 4))
     style = request.form.get('style', 'comic book')
+    fresh = request.form.get('fresh') == '1'  # Skip the response cache for a new take
+    preview = request.form.get('preview') == '1'  # Publish panels as they are written
     
-    # Generate the story
-    markdown_story, _ = generate_story(prompt, num_panels, style)
+    # Double submits of the same request attach to the job already in flight;
+    # a fresh request never joins a cached one (or the other way round)
+    job_id = job_queue.submit(
+        run_generation_job, prompt, num_panels, style,
+        bypass_cache=fresh,
+        preview=preview,
+        dedupe_key=("generate", prompt, num_panels, style, fresh)
+    )
     
-    # Create a unique ID for the story
-    story_id = str(uuid.uuid4())
+    # Return JSON response if AJAX request, otherwise let the homepage poll the job
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status_url": url_for("job_status", job_id=job_id),
+            "stream_url": url_for("job_stream", job_id=job_id)
+        }), 202
+    else:
+        return redirect(url_for("index", job=job_id, _anchor="generate"))
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the current stage of a generation job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
     
-    # Skip image generation - create an empty image paths array
-    image_paths = []
+    response = {
+        "success": True,
+        "job_id": job["id"],
+        "stage": job["stage"],
+        "done": job["done"],
+        "error": job["error"]
+    }
+    if job["result"]:
+        response["story_id"] = job["result"]["story_id"]
+        response["story_url"] = url_for("story", story_id=job["result"]["story_id"])
+    return jsonify(response)
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """Follow a generation job over Server-Sent Events: stages, preview parts, then the saved story.
     
-    # Save the story (without images)
-    story_data = save_story(prompt, markdown_story, image_paths, [])
+    The job runs in the background either way; this only relays what it
+    publishes, so a dropped connection loses nothing and no story is created here.
+    """
+    def follow():
+        stage, sent = None, 0
+        while True:
+            job = job_queue.get(job_id)
+            if job is None:
+                yield sse_event("failed", {"error": "Job not found"})
+                return
+            if job["stage"] != stage:
+                stage = job["stage"]
+                yield sse_event("stage", {"stage": stage})
+            for item in job["events"][sent:]:
+                yield sse_event(item["event"], item["data"])
+            sent = len(job["events"])
+            if job["done"]:
+                if job["result"]:
+                    yield sse_event("saved", {
+                        "story_id": job["result"]["story_id"],
+                        "story_url": url_for("story", story_id=job["result"]["story_id"])
+                    })
+                else:
+                    yield sse_event("failed", {"error": job["error"]})
+                return
+            time.sleep(JOB_STREAM_POLL_SECONDS)
     
-    # Return JSON response if AJAX request, otherwise redirect
-    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-        return jsonify({"success": True, "story": story_data})
+    response = Response(stream_with_context(follow()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the stream
+    return response
+
+@app.route('/render/<story_id>/<int:panel>')
+def render_panel(story_id, panel):
+    """Render a panel image on demand, deterministically, behind an ETag"""
+    story_data = get_story(story_id)
+    if story_data is None:
+        return jsonify({"success": False, "error": "Story not found"}), 404
+    
+    prompt = resolve_panel_prompt(story_data, panel)
+    if prompt is None:
+        return jsonify({"success": False, "error": "Invalid panel index"}), 404
+    
+    style = story_data.get("style", "comic book")
+    seed_id = seed_story_id(story_data)
+    etag = render_etag(seed_id, panel, prompt, style)
+    
+    # The same URL, version and inputs always produce the same bytes
+    if request.args.get("v") == RENDER_URL_VERSION:
+        cache_control = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
     else:
-        return redirect(url_for("story", story_id=story_data["id"]))
+        cache_control = "public, no-cache"
+    
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = rendered_panel_cache.get(etag)
+        if body is None:
+            body = render_flight.do(etag, render_panel_bytes, seed_id, panel, prompt, style)
+            rendered_panel_cache.set(etag, body)
+        response = Response(body, mimetype="image/jpeg")
+    
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+@app.after_request
+def cache_story_images(response):
+    """Story images are content-addressed, so a URL always names the same bytes"""
+    if request.path.startswith(f"/{STATIC_IMG_DIR}/") and response.status_code == 200:
+        response.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    return response
 
 @app.route('/story/<story_id>')
 def story(story_id):
     """View a specific story"""
     # Find the story with the given ID
-    stories = load_stories()
-    story_data = None
-    for story in stories:
-        if story["id"] == story_id:
-            story_data = story
-            break
+    story_data = get_story(story_id)
     
     if story_data is None:
         return redirect(url_for("index"))
     
-    # Convert markdown to HTML
-    story_data["html_story"] = Markup(markdown.markdown(story_data["markdown_story"]))
+    # Old ids of stories moved to the sharded layout
+    if story_data["id"] != story_id:
+        return redirect(url_for("story", story_id=story_data["id"]), code=301)
+    
+    # Revalidation is answered before any markdown or template work
+    etag = story_etag(story_data)
+    last_modified = story_last_modified(story_data)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    
+    # Convert markdown to HTML (cached per story content)
+    rendered = get_story_render(story_data)
+    story_data["html_story"] = Markup(rendered["html"])
+    story_data["intro_html"] = Markup(rendered["intro"])
+    story_data["panels"] = rendered["panels"]
+    story_data["conclusion"] = rendered["conclusion"]
     current_year = datetime.datetime.now().year
     
-    return render_template('story.html', story=story_data, current_year=current_year)
+    html = render_template('story.html', story=story_data, current_year=current_year)
+    return with_validators(Response(html, mimetype="text/html"), etag, last_modified)
 
 @app.template_filter('wordcount')
 def wordcount_filter(s):
@@ -957,69 +1858,96 @@ def get_panel_filter(panels, index):
 def regenerate_image(story_id, panel_index):
     """Regenerate a specific panel image for a story"""
     try:
-        # Find the story
-        story_path = os.path.join(STORIES_DIR, f"{story_id}.json")
-        if not os.path.exists(story_path):
-            return jsonify({"success": False, "error": "Story not found"})
-        
-        with open(story_path, "r") as f:
-            story_data = json.load(f)
-        
-        # Get the appropriate prompt
-        image_prompts = story_data.get("image_prompts", [])
         panel_idx = int(panel_index)
+        fresh = request.args.get('fresh') == '1'  # Skip the response cache for a new take
         
-        if not image_prompts or panel_idx >= len(image_prompts):
-            # Fallback to using the panel text
-            chapter_info = extract_chapter_titles_and_content(story_data["markdown_story"])
-            if panel_idx == 0:  # Cover
-                prompt = f"Create a cover image for: {story_data.get('title', 'Comic Story')}"
-            elif panel_idx <= len(chapter_info):
-                prompt = generate_image_prompt(
-                    chapter_info[panel_idx-1]["title"], 
-                    chapter_info[panel_idx-1]["content"]
-                )
-            else:
-                return jsonify({"success": False, "error": "Invalid panel index"})
-        else:
-            # Use the stored prompt
-            prompt = image_prompts[panel_idx]["prompt"]
-        
-        # Generate a new image
-        timestamp = get_timestamp()
-        
-        if panel_idx == 0:  # Cover
-            image_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_cover.jpg"
-        else:
-            image_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_panel{panel_idx}.jpg"
-        
-        style = "comic book"  # Default style
-        image_result = generate_image(prompt, image_path, style)
-        
-        if image_result:
-            # Update the story data with the new image path
-            if panel_idx < len(story_data["image_paths"]):
-                story_data["image_paths"][panel_idx] = image_result
-            else:
-                story_data["image_paths"].append(image_result)
-            
-            # Save the updated story data
-            with open(story_path, "w") as f:
-                json.dump(story_data, f, indent=2)
-            
-            return jsonify({
-                "success": True, 
-                "new_image": image_result,
-                "panel_index": panel_idx
-            })
-        else:
-            return jsonify({"success": False, "error": "Failed to generate image"})
-        
+        # Repeated clicks on the same panel share one regeneration of the same kind
+        result = regenerate_flight.do(
+            (story_id, panel_idx, fresh),
+            regenerate_story_image, story_id, panel_idx, bypass_cache=fresh
+        )
+        response = jsonify(result)
+        # A side-effecting GET: never let a cache answer it
+        response.headers["Cache-Control"] = "no-store"
+        return response
     except Exception as e:
         print(f"Error regenerating image: {e}")
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)})
 
+def resolve_panel_prompt(story_data, panel_idx):
+    """Image prompt for one panel of a story (0 is the cover), or None if there is no such panel"""
+    image_prompts = story_data.get("image_prompts", [])
+    
+    if not image_prompts or panel_idx >= len(image_prompts):
+        # Fallback to using the panel text
+        chapter_info = extract_chapter_titles_and_content(story_data["markdown_story"])
+        if panel_idx == 0:  # Cover
+            return f"Create a cover image for: {story_data.get('title', 'Comic Story')}"
+        if panel_idx <= len(chapter_info):
+            return generate_image_prompt(
+                chapter_info[panel_idx-1]["title"], 
+                chapter_info[panel_idx-1]["content"]
+            )
+        return None
+    
+    # Use the stored prompt
+    return image_prompts[panel_idx]["prompt"]
+
+def regenerate_story_image(story_id, panel_idx, bypass_cache=False):
+    """Generate a new image for one panel (0 is the cover) and store it on the story"""
+    # Find the story
+    story_data = get_story(story_id)
+    if story_data is None:
+        return {"success": False, "error": "Story not found"}
+    
+    # Get the appropriate prompt
+    prompt = resolve_panel_prompt(story_data, panel_idx)
+    if prompt is None:
+        return {"success": False, "error": "Invalid panel index"}
+    
+    # Generate a new image
+    timestamp = get_timestamp()
+    story_id = story_data["id"]
+    
+    if panel_idx == 0:  # Cover
+        image_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_cover.jpg"
+    else:
+        image_path = f"{STATIC_IMG_DIR}/{story_id}_{timestamp}_panel{panel_idx}.jpg"
+    
+    style = story_data.get("style", "comic book")
+    # The timestamp makes each explicit regeneration a new take, not the same image again
+    image_result = generate_image(
+        prompt, image_path, style, bypass_cache=bypass_cache,
+        seed=panel_seed(seed_story_id(story_data), panel_idx, prompt, nonce=time.time_ns())
+    )
+    
+    if image_result:
+        def set_panel_image(story_data):
+            # Slot 0 is the cover; missing slots before this panel stay empty
+            image_paths = story_data.setdefault("image_paths", [])
+            if panel_idx >= len(image_paths):
+                image_paths.extend([None] * (panel_idx + 1 - len(image_paths)))
+            image_paths[panel_idx] = image_result
+        
+        # Only the record update is locked; the slow generation above is not,
+        # so regenerations of different panels run in parallel
+        if panel_idx == 0 and os.path.isfile(image_result):
+            image_pipeline.make_thumbnail(image_result, THUMBNAIL_WIDTH)
+        story_data = update_story(story_id, set_panel_image, images=[image_result])
+        if story_data is None:
+            return {"success": False, "error": "Story not found"}
+        
+        return {
+            "success": True, 
+            "new_image": image_result,
+            "panel_index": panel_idx,
+            "version": story_data["version"],
+            "etag": story_etag(story_data)
+        }
+    else:
+        return {"success": False, "error": "Failed to generate image"}
+
 def create_minimal_image(image_path, prompt_text, style="comic book"):
     """Create a simple comic-style panel with text only - no placeholders"""
     try:
@@ -1059,7 +1987,7 @@ def create_minimal_image(image_path, prompt_text, style="comic book"):
         key_phrases = extract_key_phrases(prompt_text)
         
         # Add title/caption at the top
-        title = extract_title(prompt_text)
+        title = shorten_description(prompt_text, 60)
         title_y = 50
         
         # Draw title with white text on dark background
@@ -1081,9 +2009,8 @@ def create_minimal_image(image_path, prompt_text, style="comic book"):
             font_size=18
         )
         
-        # Ensure directory exists and save
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        image.save(image_path)
+        # Write the primary JPEG and its responsive variants, named by content
+        image_path = image_pipeline.save(image, image_path)["src"]
         
         return image_path
     except Exception as e:
@@ -1112,28 +2039,111 @@ def extract_key_phrases(text, max_phrases=3):
 
 def draw_centered_text(draw, text, x, y, color, font_size=24):
     """Draw centered text with wrapping"""
-    # Simple word wrap (proper font metrics would be better but this works for basic cases)
-    words = text.split()
-    lines = []
-    current_line = []
-    
-    for word in words:
-        test_line = current_line + [word]
-        if len(' '.join(test_line)) * (font_size // 10) < 700:  # rough estimate
-            current_line = test_line
-        else:
-            lines.append(' '.join(current_line))
-            current_line = [word]
-    
-    if current_line:
-        lines.append(' '.join(current_line))
+    font = get_font(font_size)
+    lines = wrap_text(text, font, 700)
     
     # Draw each line centered
     current_y = y
     for line in lines:
-        line_width = len(line) * (font_size // 2)  # rough estimate
-        draw.text((x - line_width//2, current_y), line, fill=color)
+        line_width = text_width(font, line)
+        draw.text((x - line_width//2, current_y), line, fill=color, font=font)
         current_y += font_size * 1.2
 
+# Optionally warm up the model handles in the background at startup
+if GEMINI_API_KEY and os.getenv("MODEL_WARMUP", "").lower() in ("1", "true", "yes"):
+    threading.Thread(target=warm_up_models, name="model-warmup", daemon=True).start()
+
+@app.cli.command("migrate-stories")
+@click.option("--db", "db_path", default=STORY_DB_PATH, show_default=True, help="SQLite database to import into.")
+@click.option("--source", default=STORIES_DIR, show_default=True, help="Directory containing story JSON files.")
+@click.option("--overwrite", is_flag=True, help="Replace stories that already exist in the database.")
+def migrate_stories_command(db_path, source, overwrite):
+    """Import stories/*.json into the SQLite story store."""
+    from story_store import SqliteStoryStore
+    
+    store = SqliteStoryStore(db_path)
+    imported, skipped = store.import_json_dir(source, overwrite=overwrite)
+    # Rebuilt from the store on the next search
+    search_index.mark_stale()
+    click.echo(f"Imported {imported} stories into {db_path} ({skipped} skipped)")
+
+@app.cli.command("shard-stories")
+@click.option("--source", default=STORIES_DIR, show_default=True, help="Directory of flat stories/<id>.json files.")
+@click.option("--dest", default=STORIES_DIR, show_default=True, help="Root of the sharded layout.")
+@click.option("--keep", is_flag=True, help="Leave the flat files in place after copying them.")
+def shard_stories_command(source, dest, keep):
+    """Move flat story files into the sharded layout used by STORY_STORE=sharded."""
+    from story_store import ShardedJsonStoryStore
+    
+    store = ShardedJsonStoryStore(dest)
+    moved, skipped = store.import_flat_dir(source, remove=not keep)
+    # Indexed under their old ids until rebuilt on the next search
+    search_index.mark_stale()
+    click.echo(f"{'Copied' if keep else 'Moved'} {moved} stories into {dest} ({skipped} skipped)")
+
+@app.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the full-text search index from the story store."""
+    stories = story_store.list_all()
+    search_index.rebuild(stories)
+    click.echo(f"Indexed {len(stories)} stories ({search_index.backend})")
+
+@app.cli.command("gc-images")
+@click.option("--grace", "grace_seconds", default=3600, show_default=True,
+              help="Only delete unreferenced files older than this many seconds.")
+@click.option("--max-bytes", type=int, default=None,
+              help="Disk budget for the image directory; derived variants are evicted LRU to fit.")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted without deleting it.")
+def gc_images_command(grace_seconds, max_bytes, dry_run):
+    """Delete images no story references and optionally enforce a disk budget."""
+    stories = load_stories()
+    
+    # Everything a story points at, plus what can be derived from its images
+    referenced = set()
+    evictable = set()
+    for story_data in stories:
+        for path in story_data.get("image_paths", []):
+            if not path:
+                continue
+            derived = image_pipeline.derived_paths(path)
+            referenced.add(path)
+            referenced.update(derived)
+            evictable.update(derived - {image_pipeline.thumbnail_path(path)})
+        if story_data.get("thumbnail"):
+            referenced.add(story_data["thumbnail"])
+        for manifest in (story_data.get("image_manifests") or {}).values():
+            referenced.update(manifest_paths(manifest))
+    
+    orphans = find_orphans(STATIC_IMG_DIR, referenced, grace_seconds)
+    for path in orphans:
+        if not dry_run:
+            os.remove(path)
+    click.echo(f"{'Would delete' if dry_run else 'Deleted'} {len(orphans)} unreferenced image files")
+    
+    if max_bytes is None:
+        return
+    
+    # Only resized/alternate-format variants are evicted; pages fall back to the
+    # sizes and formats left. They are not re-encoded unless the panel is regenerated.
+    evictions, remaining = select_evictions(STATIC_IMG_DIR, evictable, max_bytes)
+    if not dry_run:
+        for path in evictions:
+            os.remove(path)
+        # Rebuild the manifests that pointed at evicted files
+        evicted = set(evictions)
+        for story_data in stories:
+            manifests = story_data.get("image_manifests") or {}
+            if any(manifest_paths(manifest) & evicted for manifest in manifests.values()):
+                update_story(
+                    story_data["id"], lambda record: record.update(image_manifests={}),
+                    images=[path for path in story_data.get("image_paths", []) if path]
+                )
+    click.echo(
+        f"{'Would evict' if dry_run else 'Evicted'} {len(evictions)} derived image files; "
+        f"{remaining} bytes in {STATIC_IMG_DIR}"
+    )
+    if remaining > max_bytes:
+        click.echo("Still over budget: only derived variants are evicted, not primary images")
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,278 @@
+"""Threaded load generator for the HTTP endpoints.
+
+Start the app against the offline Gemini fake, then drive it:
+
+    GEMINI_FAKE=1 GEMINI_FAKE_LATENCY=lognormal:1.5:0.6 GEMINI_FAKE_429_RATE=0.05 flask run
+    python -m benchmarks.loadtest --url http://127.0.0.1:5000 --concurrency 16 --duration 60
+
+or, without a server, against the app in this process (GEMINI_FAKE is
+switched on automatically):
+
+    python -m benchmarks.loadtest --in-process --concurrency 8 --duration 20
+
+Each worker repeatedly picks an endpoint from --mix by weight. Per endpoint
+the report gives requests, errors, throughput and p50/p95/p99 latency;
+``generate:job`` is the time from submitting /generate until the job is
+saved. The endpoints are:
+
+    generate     POST /generate (the response is the queued job)
+    regenerate   GET /regenerate-image/<story>/<panel>?fresh=1
+    story        GET /story/<story>
+    index        GET /
+    stories      GET /api/stories
+    search       GET /search?q=<word>
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import itertools
+import threading
+from collections import defaultdict
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "generate=1,regenerate=2,story=6,index=2,stories=2,search=2"
+SEARCH_WORDS = ["dragon", "knight", "harbor", "courier", "desert", "moment"]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(ENDPOINTS)
+    if unknown:
+        raise ValueError(f"Unknown endpoints in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class HttpClient:
+    """Requests against a running server; one session per worker thread"""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self._requests = requests
+        self._local = threading.local()
+
+    def request(self, method, path, **kwargs):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.request(method, self.base_url + path, timeout=300, **kwargs)
+        return response.status_code, response.headers.get("Content-Type", ""), response.content
+
+
+class InProcessClient:
+    """Requests against the Flask app in this process, through its test client"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, data=None, headers=None):
+        response = self.app.test_client().open(path, method=method, data=data, headers=headers)
+        return response.status_code, response.content_type or "", response.get_data()
+
+
+class LoadTest:
+    def __init__(self, client, mix, seed=None, poll_interval=0.25):
+        self.client = client
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.seed = seed
+        self.poll_interval = poll_interval
+        self.counter = itertools.count()
+        self.story_ids = []
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def load_story_ids(self):
+        status, _, body = self.client.request("GET", "/api/stories?limit=100")
+        if status == 200:
+            self.story_ids = [story["id"] for story in json.loads(body)["stories"]]
+
+    def pick_story(self, rng):
+        with self._lock:
+            return rng.choice(self.story_ids) if self.story_ids else None
+
+    def timed(self, name, method, path, ok_statuses=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            status, content_type, body = self.client.request(method, path, **kwargs)
+        except Exception as e:
+            print(f"Error requesting {path}: {e}")
+            self.record(name, time.perf_counter() - started, False)
+            return None, None
+        ok = status in ok_statuses
+        if ok and content_type.startswith("application/json"):
+            payload = json.loads(body)
+            ok = payload.get("success", True)
+        else:
+            payload = None
+        self.record(name, time.perf_counter() - started, ok)
+        return status, payload
+
+    def worker(self, deadline, rng):
+        while time.monotonic() < deadline:
+            name = rng.choices(self.names, self.weights)[0]
+            ENDPOINTS[name](self, rng)
+
+    def run(self, concurrency, duration):
+        self.load_story_ids()
+        deadline = time.monotonic() + duration
+        seeds = random.Random(self.seed)
+        threads = [
+            threading.Thread(target=self.worker, args=(deadline, random.Random(seeds.random())), daemon=True)
+            for _ in range(concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        rows = {}
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            rows[name] = {
+                "requests": len(values),
+                "errors": self.errors[name],
+                "throughput": len(values) / elapsed,
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return rows
+
+
+def hit_generate(test, rng):
+    # A unique prompt per request, so the job queue does not merge them
+    prompt = f"Load test story {next(test.counter)} about a {rng.choice(SEARCH_WORDS)}"
+    submitted = time.perf_counter()
+    status, payload = test.timed(
+        "generate", "POST", "/generate", ok_statuses=(202,),
+        data={"prompt": prompt, "num_panels": "4", "style": "comic book", "fresh": "1"},
+        headers={"X-Requested-With": "XMLHttpRequest"}
+    )
+    if not payload or not payload.get("success"):
+        return
+    while True:
+        time.sleep(test.poll_interval)
+        code, _, body = test.client.request("GET", payload["status_url"])
+        job = json.loads(body) if code == 200 else None
+        if job is None or job.get("done"):
+            break
+    ok = bool(job and job.get("story_id"))
+    test.record("generate:job", time.perf_counter() - submitted, ok)
+    if ok:
+        with test._lock:
+            test.story_ids.append(job["story_id"])
+
+
+def hit_regenerate(test, rng):
+    story_id = test.pick_story(rng)
+    if story_id:
+        test.timed("regenerate", "GET", f"/regenerate-image/{story_id}/{rng.randint(0, 4)}?fresh=1")
+
+
+def hit_story(test, rng):
+    story_id = test.pick_story(rng)
+    if story_id:
+        test.timed("story", "GET", f"/story/{story_id}")
+
+
+def hit_index(test, rng):
+    test.timed("index", "GET", "/")
+
+
+def hit_stories(test, rng):
+    test.timed("stories", "GET", "/api/stories")
+
+
+def hit_search(test, rng):
+    test.timed("search", "GET", f"/search?q={rng.choice(SEARCH_WORDS)}")
+
+
+ENDPOINTS = {
+    "generate": hit_generate,
+    "regenerate": hit_regenerate,
+    "story": hit_story,
+    "index": hit_index,
+    "stories": hit_stories,
+    "search": hit_search,
+}
+
+
+def print_report(rows, elapsed, concurrency):
+    print(f"\n{concurrency} workers for {elapsed:.1f}s")
+    print(f"{'endpoint':<14} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, row in rows.items():
+        print(
+            f"{name:<14} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>8.2f} "
+            + " ".join(f"{row[key] * 1000:>7.0f}ms" for key in ("p50", "p95", "p99", "max"))
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the HTTP endpoints and report latency percentiles.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server.")
+    target.add_argument("--in-process", action="store_true", help="Load the app in this process with GEMINI_FAKE=1.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of worker threads.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to generate load for.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Endpoint weights, e.g. generate=1,story=5.")
+    parser.add_argument("--seed", type=int, help="Seed for the endpoint choices.")
+    parser.add_argument("--output", help="Also write the report as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    if args.in_process:
+        # Fake model and a scratch working directory, so the repository stays untouched
+        os.environ["GEMINI_FAKE"] = "1"
+        os.environ.setdefault("GEMINI_FAKE_LATENCY", "lognormal:0.8:0.5")
+        output = os.path.abspath(args.output) if args.output else None
+        sys.path.insert(0, REPO_DIR)
+        os.chdir(tempfile.mkdtemp(prefix="aicomic-load-"))
+        import app
+
+        client = InProcessClient(app.app)
+    else:
+        output = args.output
+        client = HttpClient(args.url)
+
+    test = LoadTest(client, mix, seed=args.seed)
+    elapsed = test.run(args.concurrency, args.duration)
+    rows = test.report(elapsed)
+    print_report(rows, elapsed, args.concurrency)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "duration": elapsed, "mix": mix, "endpoints": rows}, f, indent=2)
+        print(f"\nWrote {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""Benchmarks for the story, parsing and rendering hot paths.
+
+Runs offline against a stubbed google.generativeai, in a scratch working
+directory so no stories or images are written to the repository:
+
+    python -m benchmarks.run                      # full run, results in benchmarks/results.json
+    python -m benchmarks.run --quick              # smaller story sets, fewer repeats
+    python -m benchmarks.run --save-baseline      # also store the results as the baseline
+    python -m benchmarks.run --filter load_stories
+
+Every run is compared against the baseline (benchmarks/baseline.json by
+default) when one exists; the exit status is 1 if any benchmark got slower
+than --threshold. Baselines are machine specific, so record one on the
+machine you compare on.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import timeit
+import argparse
+import platform
+import datetime
+import tempfile
+import itertools
+import subprocess
+
+from benchmarks import stub_genai
+from fake_gemini import fake_story
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, "benchmarks", "results.json")
+DEFAULT_BASELINE = os.path.join(REPO_DIR, "benchmarks", "baseline.json")
+
+# The styles offered on the homepage; each has its own colors in bg_colors
+STYLES = ["comic book", "manga", "pixel art", "watercolor", "3D rendered"]
+
+WORDS = (
+    "hero villain city night neon rain shadow light robot dragon ship storm "
+    "signal secret tower river forest engine mirror crowd quiet sudden golden "
+    "broken ancient bright dark mysterious happy vibrant gloomy sunny colorful"
+).split()
+
+
+def synthetic_story(app, rng, index, num_panels=4):
+    """A story record built the way save_story builds one from a (fake) model answer"""
+    prompt = " ".join(rng.choice(WORDS) for _ in range(10)).capitalize() + "."
+    raw_story = fake_story(num_panels, rng)
+    markdown_story, image_prompts, _ = app.parse_story_response(raw_story, prompt, num_panels)
+    created = datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=index)
+    return {
+        "id": f"bench-{index:07d}",
+        "prompt": prompt,
+        "markdown_story": markdown_story,
+        "image_paths": [],
+        "image_prompts": image_prompts,
+        "created_date": created.strftime("%Y-%m-%d %H:%M:%S"),
+        "title": app.extract_title_from_markdown(markdown_story),
+        "excerpt": app.make_excerpt(markdown_story),
+    }
+
+
+def write_story_files(app, stories_dir, count, seed=1234):
+    """Fill a directory with ``count`` synthetic story files (flat JSON layout)"""
+    os.makedirs(stories_dir, exist_ok=True)
+    rng = random.Random(seed)
+    for index in range(count):
+        story_data = synthetic_story(app, rng, index)
+        with open(os.path.join(stories_dir, f"{story_data['id']}.json"), "w") as f:
+            json.dump(story_data, f)
+
+
+def measure(fn, repeat, min_time):
+    """Time fn like timeit: enough loops per repeat to run for min_time; per-call seconds"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = [elapsed / number] + [t / number for t in timer.repeat(repeat=repeat - 1, number=number)]
+    times.sort()
+    return {
+        "median": times[len(times) // 2],
+        "min": times[0],
+        "max": times[-1],
+        "loops": number,
+        "repeat": repeat,
+    }
+
+
+def build_cases(app, workdir, sizes):
+    """Return (name, setup, fn) tuples; setup runs once, untimed, before fn is measured"""
+    from story_store import create_story_store
+
+    rng = random.Random(42)
+    story = synthetic_story(app, rng, 0, num_panels=6)
+    markdown_story = story["markdown_story"]
+    # Image prompts are extracted from the raw answer, before the section is cut off
+    raw_story = fake_story(6, rng)
+    description = (
+        "A mysterious hero stands on a neon rooftop at night, rain falling, a robot companion "
+        "at her side, watching the dark city below as a storm gathers over the ancient tower."
+    )
+    cases = []
+
+    for size in sizes:
+        stories_dir = os.path.join(workdir, f"stories-{size}")
+
+        def setup(stories_dir=stories_dir, size=size):
+            if not os.path.isdir(stories_dir):
+                print(f"  writing {size} synthetic stories...", flush=True)
+                write_story_files(app, stories_dir, size)
+
+        def load_cold(stories_dir=stories_dir):
+            # A fresh store, as after a restart: every record is read from disk
+            app.story_store = create_story_store(app.STORY_STORE, stories_dir, os.path.join(stories_dir, "stories.db"))
+            return app.load_stories()
+
+        def warm_setup(stories_dir=stories_dir, setup=setup):
+            setup()
+            app.story_store = create_story_store(app.STORY_STORE, stories_dir, os.path.join(stories_dir, "stories.db"))
+            app.load_stories()
+
+        cases.append((f"load_stories[{size},cold]", setup, load_cold))
+        cases.append((f"load_stories[{size},warm]", warm_setup, app.load_stories))
+
+    cases.append(("markdown.markdown", None, lambda: app.markdown.markdown(markdown_story)))
+    cases.append(("split_by_panels", None, lambda: app.split_by_panels_filter(markdown_story)))
+    cases.append(("extract_image_prompts", None, lambda: app.extract_image_prompts(raw_story)))
+    cases.append(("parse_story_response", None, lambda: app.parse_story_response(raw_story, story["prompt"], 6)))
+    cases.append((
+        "extract_key_phrases_from_description", None,
+        lambda: app.extract_key_phrases_from_description(description)
+    ))
+
+    # Images are stored by content, so a repeat that wrote the same bytes to
+    # the same directory would skip encoding; every call gets its own directory
+    image_dir = os.path.join(workdir, "images")
+    counter = itertools.count()
+    for style in STYLES:
+        cases.append((
+            f"render_art_image[{style}]", None,
+            lambda style=style: app.render_art_image(description, style, random.Random(next(counter)))
+        ))
+        cases.append((
+            f"create_art_based_image[{style}]", None,
+            lambda style=style: app.create_art_based_image(
+                os.path.join(image_dir, str(next(counter)), "art.jpg"), description, style, seed=1
+            )
+        ))
+        cases.append((
+            f"create_minimal_image[{style}]", None,
+            lambda style=style: app.create_minimal_image(
+                os.path.join(image_dir, str(next(counter)), "minimal.jpg"), description, style
+            )
+        ))
+    return cases
+
+
+def compare(results, baseline, threshold):
+    """Print current vs baseline medians; return the names that regressed beyond threshold"""
+    regressions = []
+    print(f"\n{'benchmark':<48} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print(f"{name:<48} {'-':>12} {format_seconds(result['median']):>12} {'new':>8}")
+            continue
+        change = result["median"] / previous["median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<48} {format_seconds(previous['median']):>12} "
+            f"{format_seconds(result['median']):>12} {change:>+7.1%}{flag}"
+        )
+    return regressions
+
+
+def format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the story, parsing and rendering hot paths.")
+    parser.add_argument("--sizes", default="10,1000,100000", help="Comma-separated story counts for load_stories.")
+    parser.add_argument("--quick", action="store_true", help="Only 10 and 1000 stories, fewer repeats.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repeats per benchmark (median is reported).")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per repeat.")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Where to write the JSON results.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Also write the results to --baseline.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown (0.2 = 20%%) reported as a regression.")
+    parser.add_argument("--workdir", help="Scratch directory to keep between runs (synthetic stories are reused).")
+    args = parser.parse_args(argv)
+
+    sizes = [10, 1000] if args.quick else [int(size) for size in args.sizes.split(",") if size]
+    repeat = 3 if args.quick else args.repeat
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="aicomic-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+
+    # app resolves stories/, static/ and the search index relative to the working directory
+    sys.path.insert(0, REPO_DIR)
+    stub_genai.install()
+    os.chdir(workdir)
+    os.environ.setdefault("SEARCH_INDEX", "memory")
+    import app
+
+    results = {}
+    try:
+        for name, setup, fn in build_cases(app, workdir, sizes):
+            if args.filter and args.filter not in name:
+                continue
+            if setup:
+                setup()
+            started = time.perf_counter()
+            results[name] = measure(fn, repeat, args.min_time)
+            print(
+                f"{name:<48} {format_seconds(results[name]['median']):>12} "
+                f"({results[name]['loops']} loops x {repeat}, {time.perf_counter() - started:.1f}s)",
+                flush=True
+            )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "story_store": app.STORY_STORE,
+            "numpy": app.np is not None,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {output}")
+
+    regressions = []
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path, "r") as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {baseline_path}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import sys
+import types
+
+
+def install(seed=1234):
+    """Register a stub google.generativeai module backed by fake_gemini; call before importing app.
+
+    Every model answers instantly (``fixed:0`` latency) and never fails, so
+    the benchmarks time the app's own code on the answers it really parses.
+    """
+    from fake_gemini import FakeGenerativeModel, FakeGeminiSettings
+
+    settings = FakeGeminiSettings(latency="fixed:0", seed=seed)
+
+    class StubGenerativeModel(FakeGenerativeModel):
+        def __init__(self, model_name=None, generation_config=None, **kwargs):
+            super().__init__(model_name, generation_config, settings=settings)
+
+    module = types.ModuleType("google.generativeai")
+    module.configure = lambda **kwargs: None
+    module.GenerativeModel = StubGenerativeModel
+    google = sys.modules.get("google")
+    if google is None:
+        google = types.ModuleType("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    google.generativeai = module
+    sys.modules["google.generativeai"] = module
+    return module
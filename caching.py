@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded in-memory LRU cache with optional TTL"""
+
+    def __init__(self, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default"""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if full"""
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Remove a single key if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        """Remove every key for which predicate(key) is true"""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """JSON-file cache tier in a directory, with optional TTL and size budget.
+
+    Keys must be filename-safe strings. When ``max_bytes`` is set, the least
+    recently read entries are removed after a write pushes the directory over
+    budget.
+    """
+
+    def __init__(self, directory, max_bytes=None, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default"""
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.ttl and stat.st_mtime + self.ttl <= time.time():
+                os.remove(path)
+                return default
+            with open(path, "r") as f:
+                value = json.load(f)
+            # Bump the access time (keeping mtime for the TTL) so budget
+            # eviction treats the entry as recently used
+            os.utime(path, (time.time(), stat.st_mtime))
+            return value
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            print(f"Error reading cache entry {path}: {e}")
+            return default
+
+    def set(self, key, value):
+        """Store a JSON-serializable value"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            print(f"Error writing cache entry for {key}: {e}")
+            traceback.print_exc()
+            return
+        if self.max_bytes:
+            self._enforce_budget()
+
+    def pop(self, key):
+        """Remove a single key if present"""
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix):
+        """Remove every entry whose key starts with prefix"""
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+
+    def _enforce_budget(self):
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+class TieredCache:
+    """In-memory LRU in front of an optional DiskCache"""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key, _MISSING)
+            if value is not _MISSING:
+                self.memory.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def delete_prefix(self, prefix):
+        self.memory.discard_where(lambda key: key.startswith(prefix))
+        if self.disk is not None:
+            self.disk.delete_prefix(prefix)
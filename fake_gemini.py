@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+
+try:
+    from google.api_core import exceptions as api_exceptions
+except ImportError:  # The fake also runs without the Google client libraries
+    api_exceptions = None
+
+
+class FakeAPIError(Exception):
+    """Stand-in for a Google API error; ``code`` is the HTTP status, as is_retryable expects"""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+def api_error(code, message):
+    """Build the error the real SDK would raise for an HTTP status"""
+    if api_exceptions is not None:
+        return api_exceptions.from_http_status(code, message)
+    return FakeAPIError(code, message)
+
+
+def parse_latency(spec):
+    """Parse a latency distribution into a sampler taking a random.Random.
+
+    ``fixed:<s>``, ``uniform:<low>:<high>``, ``normal:<mean>:<stddev>`` or
+    ``lognormal:<median>:<sigma>``; all in seconds, never negative.
+    """
+    kind, *params = spec.split(":")
+    try:
+        params = [float(param) for param in params]
+        if kind == "fixed":
+            (seconds,) = params
+            return lambda rng: seconds
+        if kind == "uniform":
+            low, high = params
+            return lambda rng: rng.uniform(low, high)
+        if kind == "normal":
+            mean, stddev = params
+            return lambda rng: max(rng.gauss(mean, stddev), 0.0)
+        if kind == "lognormal":
+            median, sigma = params
+            return lambda rng: median * rng.lognormvariate(0, sigma)
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency distribution: {spec!r}")
+
+
+class FakeGeminiSettings:
+    """Behaviour of the fake model, read from GEMINI_FAKE_* environment variables"""
+
+    def __init__(self, latency="lognormal:0.8:0.5", rate_429=0.0, rate_500=0.0,
+                 rate_timeout=0.0, rate_malformed=0.0, stream_chunks=8, hang_seconds=30.0, seed=None):
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.rate_timeout = rate_timeout
+        self.rate_malformed = rate_malformed
+        self.stream_chunks = max(stream_chunks, 1)
+        self.hang_seconds = hang_seconds
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv("GEMINI_FAKE_SEED")
+        return cls(
+            latency=os.getenv("GEMINI_FAKE_LATENCY", "lognormal:0.8:0.5"),
+            rate_429=float(os.getenv("GEMINI_FAKE_429_RATE", "0")),
+            rate_500=float(os.getenv("GEMINI_FAKE_500_RATE", "0")),
+            rate_timeout=float(os.getenv("GEMINI_FAKE_TIMEOUT_RATE", "0")),
+            rate_malformed=float(os.getenv("GEMINI_FAKE_MALFORMED_RATE", "0")),
+            stream_chunks=int(os.getenv("GEMINI_FAKE_STREAM_CHUNKS", "8")),
+            hang_seconds=float(os.getenv("GEMINI_FAKE_HANG_SECONDS", "30")),
+            seed=int(seed) if seed else None,
+        )
+
+    def draw(self):
+        """Sample (latency, outcome, malformed) for one call.
+
+        The outcome is None for success, or 429, 500 or "timeout".
+        """
+        with self._lock:
+            latency = self.latency(self.rng)
+            roll = self.rng.random()
+            malformed = self.rng.random() < self.rate_malformed
+            variant = self.rng.randrange(1 << 30)
+        outcome = None
+        for rate, result in ((self.rate_429, 429), (self.rate_500, 500), (self.rate_timeout, "timeout")):
+            if roll < rate:
+                outcome = result
+                break
+            roll -= rate
+        return latency, outcome, malformed, variant
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Offline stand-in for genai.GenerativeModel with configurable latency and failures.
+
+    Answers story prompts with markdown in the requested shape, batch
+    description prompts with a JSON array and anything else with a scene
+    description. With ``rate_malformed`` some answers are broken the way
+    real ones sometimes are (wrong number of panel headings, truncated, not
+    JSON), so the app's fallbacks get exercised. Honors
+    ``request_options={"timeout": ...}`` and ``stream=True``.
+    """
+
+    def __init__(self, model_name=None, generation_config=None, settings=None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self.settings = settings or FakeGeminiSettings.from_env()
+
+    def count_tokens(self, contents):
+        return {"total_tokens": len(str(contents).split())}
+
+    def generate_content(self, prompt, stream=False, request_options=None, **kwargs):
+        timeout = (request_options or {}).get("timeout")
+        latency, outcome, malformed, variant = self.settings.draw()
+
+        if outcome == "timeout" or (timeout is not None and latency > timeout):
+            time.sleep(timeout if timeout is not None else self.settings.hang_seconds)
+            raise TimeoutError("Fake Gemini call timed out")
+
+        text = self._answer(prompt, malformed, random.Random(variant))
+        if not stream:
+            time.sleep(latency)
+            if outcome is not None:
+                raise api_error(outcome, "Fake Gemini error")
+            return FakeResponse(text)
+
+        # Errors surface when the stream is opened, before the first chunk
+        time.sleep(latency * 0.3)
+        if outcome is not None:
+            raise api_error(outcome, "Fake Gemini error")
+        return self._stream(text, latency * 0.7)
+
+    def _stream(self, text, duration):
+        count = self.settings.stream_chunks
+        size = max(len(text) // count, 1)
+        for start in range(0, len(text), size):
+            yield FakeResponse(text[start:start + size])
+            time.sleep(duration / count)
+
+    def _answer(self, prompt, malformed, rng):
+        prompt = str(prompt)
+        if "JSON array" in prompt:
+            scenes = [int(number) for number in re.findall(r"^\s*(\d+)\. ", prompt, re.MULTILINE)]
+            return fake_batch_descriptions(scenes, rng, malformed)
+        match = re.search(r"exactly (\d+) distinct panels", prompt)
+        if match:
+            return fake_story(int(match.group(1)), rng, malformed)
+        return fake_description(rng)
+
+
+SUBJECTS = ["a caped courier", "a clockwork cat", "twin astronauts", "a retired dragon", "a pixel knight"]
+PLACES = ["a rain-soaked rooftop", "a floating market", "an abandoned arcade", "a moonlit harbor", "a glass desert"]
+MOODS = ["dark and mysterious", "bright and vibrant", "tense", "gloomy", "sunny and colorful"]
+
+
+def fake_description(rng):
+    return (
+        f"A {rng.choice(MOODS)} scene: {rng.choice(SUBJECTS)} stands in {rng.choice(PLACES)}, "
+        f"caught mid-stride with a determined expression. Dramatic rim lighting picks out the "
+        f"silhouette against a {rng.choice(['crimson', 'teal', 'violet', 'amber'])} sky. "
+        f"A speech bubble reads \"Not today!\" and the letters WHOOSH trail behind."
+    )
+
+
+def fake_story(num_panels, rng, malformed=False):
+    """Markdown shaped like a story answer; malformed ones have the wrong number of panel headings"""
+    subject, place = rng.choice(SUBJECTS), rng.choice(PLACES)
+    parts = [
+        f"# The Legend of {subject.title()}",
+        f"In {place}, {subject} is about to have the strangest day of their life.",
+    ]
+    for number in range(1, num_panels + 1):
+        parts.append(f"## Panel {number}: Moment {number}")
+        parts.append(f"{fake_description(rng)} \"Panel {number}, here we go!\" BOOM!")
+    parts.append(f"And so {subject} went home, wiser and a little singed.")
+    parts.append("## Image Prompts")
+    parts.append(f"Cover: {subject} posing heroically in {place}, {rng.choice(MOODS)}")
+    parts.extend(f"Panel {number}: {fake_description(rng)}" for number in range(1, num_panels + 1))
+    story = "\n\n".join(parts)
+
+    if not malformed:
+        return story
+    kind = rng.choice(["missing_panel", "extra_panel", "no_headings", "truncated"])
+    if kind == "missing_panel":
+        return re.sub(r"## Panel 1: .*\n", "", story, count=1)
+    if kind == "extra_panel":
+        return story.replace("## Image Prompts", f"## Panel {num_panels + 1}: Bonus\n\nOne more thing...\n\n## Image Prompts")
+    if kind == "no_headings":
+        return re.sub(r"^#+ ", "", story, flags=re.MULTILINE)
+    return story[:story.index(f"## Panel {max(num_panels // 2, 1)}:")]
+
+
+def fake_batch_descriptions(scenes, rng, malformed=False):
+    """A JSON array of scene descriptions; malformed ones are cut off or not JSON at all"""
+    answer = json.dumps([{"id": scene, "description": fake_description(rng)} for scene in scenes])
+    if not malformed:
+        return answer
+    if rng.random() < 0.5:
+        return answer[:len(answer) // 2]
+    return "Sure! Here are the descriptions you asked for:\n\n" + answer
@@ -0,0 +1,250 @@
+import io
+import os
+import time
+import hashlib
+import tempfile
+from PIL import Image, features
+
+# MIME type -> (Pillow format, file extension), best compression first
+IMAGE_FORMATS = {
+    "image/avif": ("AVIF", "avif"),
+    "image/webp": ("WEBP", "webp"),
+    "image/jpeg": ("JPEG", "jpg"),
+}
+
+
+def supported_formats():
+    """MIME types this Pillow build can encode, best compression first"""
+    available = {"image/jpeg"}
+    if features.check("webp"):
+        available.add("image/webp")
+    if features.check("avif"):
+        available.add("image/avif")
+    return [mime for mime in IMAGE_FORMATS if mime in available]
+
+
+class ImagePipeline:
+    """Encode one in-memory image into every configured format and width.
+
+    The full-size progressive JPEG is the primary file. With
+    ``content_addressed`` it is named after a hash of its bytes, in the
+    directory of the requested path, so identical renders share one set of
+    files; otherwise it is written to the requested path. Smaller widths and
+    the modern formats are written next to it as ``<stem>-<width>w.<ext>``.
+    ``save`` returns a manifest describing all files, which is stored on the
+    story record and turned into ``<picture>``/``srcset`` markup by the
+    templates.
+    """
+
+    def __init__(self, widths=(400, 800), formats=None, jpeg_quality=85,
+                 webp_quality=80, avif_quality=60, avif_speed=8, content_addressed=True):
+        self.widths = sorted(set(widths))
+        self.formats = [mime for mime in (formats or supported_formats()) if mime in IMAGE_FORMATS]
+        self.quality = {
+            "image/jpeg": jpeg_quality,
+            "image/webp": webp_quality,
+            "image/avif": avif_quality,
+        }
+        self.avif_speed = avif_speed
+        self.content_addressed = content_addressed
+
+    def _encode(self, image, mime):
+        """Encode an image to bytes in one of IMAGE_FORMATS"""
+        pillow_format = IMAGE_FORMATS[mime][0]
+        options = {"quality": self.quality[mime]}
+        if mime == "image/jpeg":
+            options.update(progressive=True, optimize=True)
+        elif mime == "image/webp":
+            options["method"] = 4
+        elif mime == "image/avif":
+            options["speed"] = self.avif_speed
+        buffer = io.BytesIO()
+        image.save(buffer, pillow_format, **options)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _write(path, data):
+        """Write a file atomically so readers never see a partial image"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def _resize(image, width):
+        if width == image.width:
+            return image
+        height = round(image.height * width / image.width)
+        return image.resize((width, height), Image.LANCZOS)
+
+    def variant_path(self, image_path, width, mime):
+        stem = os.path.splitext(image_path)[0]
+        return f"{stem}-{width}w.{IMAGE_FORMATS[mime][1]}"
+
+    def save(self, image, image_path):
+        """Write the primary JPEG plus every variant; return the image manifest.
+        
+        The primary file's path is ``manifest["src"]``; with content addressing
+        it differs from ``image_path``.
+        """
+        os.makedirs(os.path.dirname(image_path) or ".", exist_ok=True)
+        image = image.convert("RGB")
+        primary = self._encode(image, "image/jpeg")
+
+        stored = False
+        if self.content_addressed:
+            digest = hashlib.sha256(primary).hexdigest()[:32]
+            image_path = os.path.join(os.path.dirname(image_path), f"{digest}.jpg")
+            stored = os.path.exists(image_path)
+
+        sources = {mime: [] for mime in self.formats}
+        widths = [w for w in self.widths if w < image.width] + [image.width]
+        for width in widths:
+            resized = None
+            for mime in self.formats:
+                if mime == "image/jpeg" and width == image.width:
+                    path = image_path
+                else:
+                    path = self.variant_path(image_path, width, mime)
+                    if stored and os.path.exists(path):
+                        # Same bytes already stored; refresh the variant's age for eviction
+                        os.utime(path)
+                    else:
+                        # New image, or a variant evicted since it was last rendered
+                        if resized is None:
+                            resized = self._resize(image, width)
+                        self._write(path, self._encode(resized, mime))
+                sources[mime].append({"path": path, "width": width})
+
+        if stored:
+            # Refresh the ages the garbage collector and evictions go by
+            os.utime(image_path)
+            if os.path.exists(self.thumbnail_path(image_path)):
+                os.utime(self.thumbnail_path(image_path))
+        else:
+            # The primary goes last, so its presence means the variants are complete
+            self._write(image_path, primary)
+
+        return {
+            "src": image_path,
+            "width": image.width,
+            "height": image.height,
+            "sources": sources,
+        }
+
+    def describe(self, image_path):
+        """Rebuild the manifest of an image from the files on disk, or None if it is missing"""
+        try:
+            with Image.open(image_path) as image:
+                width, height = image.size
+        except (OSError, ValueError):
+            return None
+
+        sources = {}
+        for mime in self.formats:
+            variants = []
+            for variant_width in [w for w in self.widths if w < width] + [width]:
+                if mime == "image/jpeg" and variant_width == width:
+                    path = image_path
+                else:
+                    path = self.variant_path(image_path, variant_width, mime)
+                if os.path.exists(path):
+                    variants.append({"path": path, "width": variant_width})
+            if variants:
+                sources[mime] = variants
+
+        return {"src": image_path, "width": width, "height": height, "sources": sources}
+
+    def thumbnail_path(self, image_path):
+        stem = os.path.splitext(image_path)[0]
+        return f"{stem}-thumb.webp" if "image/webp" in self.formats else f"{stem}-thumb.jpg"
+
+    def make_thumbnail(self, image_path, width=240):
+        """Write a small cover next to an image (once) and return its path, or None"""
+        thumbnail_path = self.thumbnail_path(image_path)
+        if os.path.exists(thumbnail_path):
+            return thumbnail_path
+        try:
+            with Image.open(image_path) as image:
+                image = image.convert("RGB")
+                height = max(round(image.height * width / image.width), 1)
+                thumbnail = image.resize((width, height), Image.LANCZOS)
+        except (OSError, ValueError) as e:
+            print(f"Error creating thumbnail for {image_path}: {e}")
+            return None
+        mime = "image/webp" if thumbnail_path.endswith(".webp") else "image/jpeg"
+        self._write(thumbnail_path, self._encode(thumbnail, mime))
+        return thumbnail_path
+
+    def derived_paths(self, image_path):
+        """Files that can be rebuilt from a primary image: its variants and thumbnail"""
+        manifest = self.describe(image_path)
+        paths = manifest_paths(manifest) if manifest else set()
+        paths.add(self.thumbnail_path(image_path))
+        paths.discard(image_path)
+        return paths
+
+
+def manifest_paths(manifest):
+    """Every file a manifest refers to, including the primary image"""
+    paths = {manifest["src"]}
+    for variants in manifest.get("sources", {}).values():
+        paths.update(variant["path"] for variant in variants)
+    return paths
+
+
+def _walk_files(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            yield os.path.normpath(os.path.join(root, name))
+
+
+def find_orphans(directory, referenced, grace_seconds=3600, now=None):
+    """Files under directory that nothing references and are older than the grace period.
+
+    The grace period protects images written by requests that have not
+    saved their story record yet.
+    """
+    now = now or time.time()
+    referenced = {os.path.normpath(path) for path in referenced}
+    orphans = []
+    for path in _walk_files(directory):
+        if path in referenced:
+            continue
+        try:
+            if now - os.path.getmtime(path) >= grace_seconds:
+                orphans.append(path)
+        except OSError:
+            continue
+    return orphans
+
+
+def select_evictions(directory, evictable, max_bytes):
+    """Pick evictable files, least recently used first, to get directory under max_bytes.
+
+    Use is judged by mtime, which ``ImagePipeline.save`` refreshes whenever
+    it reuses a stored image; atime is often not updated (noatime, relatime).
+    """
+    evictable = {os.path.normpath(path) for path in evictable}
+    total = 0
+    candidates = []
+    for path in _walk_files(directory):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        total += stat.st_size
+        if path in evictable:
+            candidates.append((stat.st_mtime, stat.st_size, path))
+
+    evictions = []
+    for _, size, path in sorted(candidates):
+        if total <= max_bytes:
+            break
+        evictions.append(path)
+        total -= size
+    return evictions, total
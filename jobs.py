@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from story_store import write_json_atomic
+
+# Job stages reported to clients, in order
+STAGE_QUEUED = "queued"
+STAGE_CALLING_MODEL = "calling_model"
+STAGE_PARSING = "parsing"
+STAGE_SAVING = "saving"
+STAGE_SAVED = "saved"
+STAGE_FAILED = "failed"
+
+
+class JobProgress:
+    """Passed to job functions as ``report_stage``.
+
+    Call it with a stage to publish progress; ``event(name, data)`` appends
+    a preview event (e.g. a finished panel) for clients following the job.
+    """
+
+    def __init__(self, queue, job_id):
+        self._queue = queue
+        self._job_id = job_id
+
+    def __call__(self, stage):
+        self._queue._update(self._job_id, stage=stage)
+
+    def event(self, name, data):
+        self._queue._append_event(self._job_id, {"event": name, "data": data})
+
+
+class JobQueue:
+    """Background worker pool for long-running generation jobs.
+
+    Each job function is called as ``fn(report_stage, *args, **kwargs)``;
+    it can call ``report_stage(stage)`` to publish progress (see JobProgress)
+    and its return value becomes the job result. Finished jobs are kept for ``ttl`` seconds
+    so clients can still read their final status.
+
+    Jobs run on threads of the process that queued them. With a
+    ``status_dir`` every status change is also written to
+    ``<status_dir>/<job_id>.json``, so any worker process sharing the
+    directory can answer a status poll. A job left unfinished for longer
+    than ``ttl`` (its process died) is reported as failed.
+    """
+
+    def __init__(self, max_workers=2, ttl=3600, status_dir=None):
+        self.ttl = ttl
+        self.status_dir = status_dir
+        if status_dir:
+            os.makedirs(status_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="story-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}  # dedupe key -> ID of the unfinished job for it
+
+    def submit(self, fn, *args, dedupe_key=None, **kwargs):
+        """Queue a job and return its ID immediately.
+
+        If ``dedupe_key`` is given and an unfinished job was submitted with the
+        same key, no new job is queued and the existing job's ID is returned.
+        """
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if dedupe_key is not None and dedupe_key in self._active:
+                return self._active[dedupe_key]
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "stage": STAGE_QUEUED,
+                "done": False,
+                "result": None,
+                "error": None,
+                "events": [],
+                "created_at": now,
+                "updated_at": now
+            }
+            self._store(self._jobs[job_id])
+            if dedupe_key is not None:
+                self._active[dedupe_key] = job_id
+        self._executor.submit(self._run, job_id, dedupe_key, fn, args, kwargs)
+        return job_id
+
+    def get(self, job_id):
+        """Return a snapshot of a job, or None if it is unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return dict(job, events=list(job["events"]))
+        job = self._load(job_id)
+        if job is None:
+            return None
+        age = time.time() - job["updated_at"]
+        if job["done"] and age > self.ttl:
+            return None
+        if not job["done"] and age > self.ttl:
+            job.update(stage=STAGE_FAILED, done=True, error="Job was interrupted")
+        return job
+
+    def _status_path(self, job_id):
+        return os.path.join(self.status_dir, f"{job_id}.json")
+
+    def _store(self, job):
+        """Publish a job's status to other workers (caller holds the lock)"""
+        if not self.status_dir:
+            return
+        try:
+            write_json_atomic(self._status_path(job["id"]), job)
+        except Exception as e:
+            print(f"Error writing status of job {job['id']}: {e}")
+            traceback.print_exc()
+
+    def _load(self, job_id):
+        """Status written by another worker, or None"""
+        # Job IDs are uuid4 hex; anything else never names a status file
+        if not self.status_dir or len(job_id) != 32 or not job_id.isalnum():
+            return None
+        try:
+            with open(self._status_path(job_id), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+                self._store(job)
+
+    def _append_event(self, job_id, event):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job["events"].append(event)
+                job["updated_at"] = time.time()
+                self._store(job)
+
+    def _run(self, job_id, dedupe_key, fn, args, kwargs):
+        try:
+            result = fn(JobProgress(self, job_id), *args, **kwargs)
+            self._update(job_id, stage=STAGE_SAVED, done=True, result=result)
+        except Exception as e:
+            print(f"Error running job {job_id}: {e}")
+            traceback.print_exc()
+            self._update(job_id, stage=STAGE_FAILED, done=True, error=str(e))
+        finally:
+            if dedupe_key is not None:
+                with self._lock:
+                    if self._active.get(dedupe_key) == job_id:
+                        del self._active[dedupe_key]
+
+    def _prune(self, now):
+        """Forget finished jobs older than the TTL (caller holds the lock)"""
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["done"] and now - job["updated_at"] > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if not self.status_dir:
+            return
+        # Status files of any worker, including ones that died mid-job
+        with os.scandir(self.status_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(".json") and now - entry.stat().st_mtime > self.ttl:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
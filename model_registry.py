@@ -0,0 +1,56 @@
+import json
+import threading
+import traceback
+
+
+class ModelRegistry:
+    """Process-wide cache of model handles keyed by (model name, generation config).
+
+    ``factory(model_name, generation_config)`` builds a handle the first time a
+    key is requested; afterwards the same handle is returned to every caller.
+    Handles are shared between threads, so the factory must return objects that
+    are safe for concurrent use (the Gemini SDK's models are: all requests go
+    through one shared client and its connection pool).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._models = {}
+
+    @staticmethod
+    def _key(model_name, generation_config):
+        config_key = json.dumps(generation_config or {}, sort_keys=True)
+        return model_name, config_key
+
+    def get(self, model_name, generation_config=None):
+        """Return the shared handle for a model name and generation config"""
+        key = self._key(model_name, generation_config)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._factory(model_name, generation_config)
+                self._models[key] = model
+            return model
+
+    def warm_up(self, specs, ping=None):
+        """Build handles for (model name, generation config) pairs ahead of time.
+
+        If ``ping`` is given it is called with each handle, e.g. to make a cheap
+        request that opens the underlying connection before real traffic.
+        """
+        for model_name, generation_config in specs:
+            try:
+                model = self.get(model_name, generation_config)
+                if ping is not None:
+                    ping(model)
+            except Exception as e:
+                print(f"Error warming up model {model_name}: {e}")
+                traceback.print_exc()
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
@@ -0,0 +1,177 @@
+import time
+import random
+import threading
+
+# HTTP status codes worth retrying: rate limited or a transient upstream failure
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream the circuit breaker considers unhealthy"""
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a call (including retries and rate-limit waits) runs out of time"""
+
+
+def is_retryable(error):
+    """Return True for rate limiting, timeouts and transient server errors.
+
+    Google API errors carry the HTTP status as an integer ``code`` attribute.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    """Token-bucket rate limiter: ``rate`` tokens per second, bursts up to ``capacity``"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """Take one token, waiting up to ``timeout`` seconds; return False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Stop calling an upstream after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    every call is rejected for ``reset_timeout`` seconds. Then a single trial
+    call is let through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Return True if a call may go ahead now"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # Half-open: let exactly one trial call through
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def release(self):
+        """Give back a permission from allow() that ended up not being used"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class OutboundCallPolicy:
+    """Rate limiting, deadline, retry with jittered backoff and circuit breaking for one upstream.
+
+    ``call(fn)`` invokes ``fn(timeout)`` where ``timeout`` is the time left
+    before the overall deadline, so the callee can pass it on as a per-request
+    timeout. Retryable errors are retried with exponential backoff and full
+    jitter while time remains; other errors are raised straight away. The
+    breaker sees one outcome per call, after its retries, so its threshold
+    counts failed calls rather than attempts.
+    """
+
+    def __init__(self, rate_limiter, breaker, deadline=60.0, max_attempts=3,
+                 base_delay=0.5, max_delay=8.0):
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def call(self, fn, deadline=None):
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        if not self.breaker.allow():
+            raise CircuitOpenError("Upstream circuit is open; skipping call")
+
+        error = None
+        for attempt in range(self.max_attempts):
+            remaining = deadline_at - time.monotonic()
+            if remaining > 0 and self.rate_limiter.acquire(timeout=remaining):
+                # The wait for a token may have used up the rest of the budget
+                remaining = deadline_at - time.monotonic()
+            else:
+                remaining = 0
+            if remaining <= 0:
+                if error is None:
+                    self.breaker.release()
+                else:
+                    self.breaker.record_failure()
+                raise DeadlineExceededError("Deadline exceeded waiting for the rate limiter") from error
+
+            try:
+                result = fn(remaining)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The upstream answered; the request itself was bad
+                    self.breaker.record_success()
+                    raise
+                error = e
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                if attempt == self.max_attempts - 1 or time.monotonic() + delay >= deadline_at:
+                    self.breaker.record_failure()
+                    raise
+                print(f"Retrying upstream call after error ({e}); attempt {attempt + 2} in {delay:.2f}s")
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
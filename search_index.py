@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import math
+import heapq
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:  # Windows: other processes' writes are not noticed
+    fcntl = None
+
+# Relative weight of each indexed field in ranking
+FIELD_WEIGHTS = {"title": 10.0, "prompt": 2.0, "markdown_story": 1.0}
+
+# Runs of letters and digits; underscores separate words as in FTS5's unicode61
+TOKEN_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase word tokens without diacritics, like FTS5's unicode61 tokenizer ("café" -> "cafe")"""
+    decomposed = unicodedata.normalize("NFKD", (text or "").lower())
+    return TOKEN_PATTERN.findall("".join(char for char in decomposed if not unicodedata.combining(char)))
+
+
+def fts5_available():
+    """Return True if this SQLite build has the FTS5 extension"""
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+class Fts5SearchIndex:
+    """Story search backed by an SQLite FTS5 table, ranked with its bm25().
+
+    ``search_docs`` maps story ids to FTS rowids and holds the summary shown
+    in results, so replacing a document and rendering a result page are
+    both lookups by key. The index lives in its own database file and
+    survives restarts.
+    """
+
+    backend = "fts5"
+
+    def __init__(self, db_path, summarize):
+        self.db_path = db_path
+        self.summarize = summarize
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_docs ("
+                "rowid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, summary TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS story_fts USING fts5("
+                "title, prompt, markdown_story, tokenize='unicode61')"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @property
+    def built(self):
+        row = self._connect().execute("SELECT value FROM search_meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def rebuild(self, stories):
+        """Replace the whole index with the given story records"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM search_docs")
+            conn.execute("DELETE FROM story_fts")
+            for story_data in stories:
+                self._insert(conn, story_data)
+            conn.execute("INSERT OR REPLACE INTO search_meta (key, value) VALUES ('built', '1')")
+
+    def mark_stale(self):
+        """Have the next search rebuild the index (after stories were moved or imported)"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM search_meta WHERE key = 'built'")
+
+    def _insert(self, conn, story_data):
+        cursor = conn.execute(
+            "INSERT INTO search_docs (id, summary) VALUES (?, ?)",
+            (story_data["id"], json.dumps(self.summarize(story_data)))
+        )
+        conn.execute(
+            "INSERT INTO story_fts (rowid, title, prompt, markdown_story) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid,) + tuple(story_data.get(field) or "" for field in FIELD_WEIGHTS)
+        )
+
+    def add(self, story_data):
+        """Index a story, replacing any earlier version of it"""
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT rowid FROM search_docs WHERE id = ?", (story_data["id"],)).fetchone()
+            if row:
+                conn.execute("DELETE FROM story_fts WHERE rowid = ?", row)
+                conn.execute("DELETE FROM search_docs WHERE rowid = ?", row)
+            self._insert(conn, story_data)
+
+    def search(self, query, limit, offset=0):
+        """Return (summaries, total) for stories matching every query term, best first"""
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+        # Quoted terms, implicitly ANDed, so user input is never parsed as FTS syntax
+        match = " ".join(f'"{term}"' for term in terms)
+        weights = ", ".join(str(weight) for weight in FIELD_WEIGHTS.values())
+        conn = self._connect()
+        rows = conn.execute(
+            f"SELECT d.summary FROM story_fts JOIN search_docs d ON d.rowid = story_fts.rowid "
+            f"WHERE story_fts MATCH ? ORDER BY bm25(story_fts, {weights}) LIMIT ? OFFSET ?",
+            (match, limit, offset)
+        ).fetchall()
+        total = conn.execute("SELECT count(*) FROM story_fts WHERE story_fts MATCH ?", (match,)).fetchone()[0]
+        return [json.loads(row[0]) for row in rows], total
+
+
+class MemorySearchIndex:
+    """Pure-Python inverted index with BM25 ranking, for SQLite builds without FTS5.
+
+    Postings map each term to {document number: field-weighted term
+    frequency}. The index is kept in memory and rebuilt from the story store
+    on first use in each process, so it suits small and medium libraries;
+    use the FTS5 backend for large ones.
+
+    With a ``counter_path``, every process bumps a shared change counter
+    when it indexes a story. A process whose last seen count falls behind
+    has missed another worker's write and rebuilds on its next search.
+    """
+
+    backend = "memory"
+
+    def __init__(self, summarize, k1=1.2, b=0.75, counter_path=None):
+        self.summarize = summarize
+        self.k1 = k1
+        self.b = b
+        self.counter_path = counter_path if fcntl else None
+        self._built = False
+        self._seen = None     # change counter this index is up to date with
+        self._lock = threading.Lock()
+        self._postings = {}   # term -> {docno: weighted term frequency}
+        self._docnos = {}     # story id -> docno
+        self._docs = {}       # docno -> (summary, weighted length, terms)
+        self._next_docno = 0
+        self._total_length = 0.0
+
+    def _read_counter(self):
+        if not self.counter_path:
+            return None
+        try:
+            with open(self.counter_path, "r") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump_counter(self):
+        """Increment the shared change counter; return its (old, new) values"""
+        if not self.counter_path:
+            return None, None
+        with os.fdopen(os.open(self.counter_path, os.O_RDWR | os.O_CREAT), "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # Released when the file is closed
+            old = int(f.read() or 0)
+            # Fixed width and no truncation, so readers never see an empty file
+            f.seek(0)
+            f.write(f"{old + 1:020d}")
+            return old, old + 1
+
+    @property
+    def built(self):
+        """True once built, until another process has indexed or invalidated stories"""
+        return self._built and self._seen == self._read_counter()
+
+    def rebuild(self, stories):
+        """Replace the whole index with the given story records"""
+        with self._lock:
+            self._seen = self._read_counter()
+            self._postings, self._docnos, self._docs = {}, {}, {}
+            self._total_length = 0.0
+            for story_data in stories:
+                self._add(story_data)
+            self._built = True
+
+    def add(self, story_data):
+        """Index a story, replacing any earlier version of it"""
+        with self._lock:
+            self._add(story_data)
+            old, new = self._bump_counter()
+            if old == self._seen:
+                self._seen = new
+            # Otherwise another process changed stories too; built stays False until a rebuild
+
+    def mark_stale(self):
+        """Have the next search rebuild the index, in this and every other process"""
+        with self._lock:
+            self._built = False
+            self._bump_counter()
+
+    def _remove(self, story_id):
+        docno = self._docnos.pop(story_id, None)
+        if docno is None:
+            return
+        _, length, terms = self._docs.pop(docno)
+        self._total_length -= length
+        for term in terms:
+            postings = self._postings[term]
+            del postings[docno]
+            if not postings:
+                del self._postings[term]
+
+    def _add(self, story_data):
+        self._remove(story_data["id"])
+        frequencies = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(story_data.get(field)):
+                frequencies[term] += weight
+        length = sum(frequencies.values())
+
+        docno = self._next_docno
+        self._next_docno += 1
+        self._docnos[story_data["id"]] = docno
+        self._docs[docno] = (self.summarize(story_data), length, tuple(frequencies))
+        self._total_length += length
+        for term, frequency in frequencies.items():
+            self._postings.setdefault(term, {})[docno] = frequency
+
+    def search(self, query, limit, offset=0):
+        """Return (summaries, total) for stories matching every query term, best first"""
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if not all(postings):
+                return [], 0
+            # Intersect starting from the rarest term
+            postings.sort(key=len)
+            matches = set(postings[0]).intersection(*postings[1:])
+
+            count = len(self._docs)
+            average_length = self._total_length / count
+            idf = [math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+
+            def score(docno):
+                norm = self.k1 * (1 - self.b + self.b * self._docs[docno][1] / average_length)
+                return sum(
+                    weight * p[docno] * (self.k1 + 1) / (p[docno] + norm)
+                    for weight, p in zip(idf, postings)
+                )
+
+            best = heapq.nlargest(offset + limit, matches, key=score)
+            return [self._docs[docno][0] for docno in best[offset:]], len(matches)
+
+
+def create_search_index(backend, db_path, summarize):
+    """Create the configured search index ("fts5" or "memory"); fts5 falls back to memory.
+
+    The memory index keeps its change counter next to where the FTS5
+    database would be (``search.db`` -> ``search.counter``).
+    """
+    backend = (backend or "fts5").lower()
+    counter_path = os.path.splitext(db_path)[0] + ".counter"
+    if backend == "fts5":
+        if fts5_available():
+            return Fts5SearchIndex(db_path, summarize)
+        print("SQLite FTS5 is not available; using the in-memory search index")
+        return MemorySearchIndex(summarize, counter_path=counter_path)
+    if backend != "memory":
+        raise ValueError(f"Unknown search index backend: {backend}")
+    return MemorySearchIndex(summarize, counter_path=counter_path)
@@ -0,0 +1,51 @@
+import os
+import re
+import time
+import datetime
+
+# Crockford base32, as used by ULIDs
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ULID_PATTERN = re.compile(r"^[0-7][0-9A-HJKMNP-TV-Z]{25}$")
+# The pattern allows 48-bit timestamps (up to the year 10889); datetime stops at 9999
+MAX_ULID_MILLIS = int(datetime.datetime(9999, 12, 31, 23, 59, 59, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def new_ulid(timestamp=None):
+    """Return a new ULID: 48 bits of milliseconds since the epoch, then 80 random bits.
+
+    ULIDs sort lexicographically in creation order, so story ids double as a
+    time index. ``timestamp`` (seconds) lets old records get an id matching
+    their creation time.
+    """
+    millis = int((time.time() if timestamp is None else timestamp) * 1000)
+    value = (millis << 80) | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(ULID_ALPHABET[index])
+    return "".join(reversed(chars))
+
+
+def is_ulid(value):
+    """True for a well-formed ULID whose timestamp is a representable date"""
+    return bool(ULID_PATTERN.match(value or "")) and ulid_millis(value) <= MAX_ULID_MILLIS
+
+
+def ulid_millis(value):
+    millis = 0
+    for char in value[:10]:
+        millis = millis * 32 + ULID_ALPHABET.index(char)
+    return millis
+
+
+def ulid_datetime(value):
+    """UTC creation time encoded in a ULID; ValueError if it is past the year 9999"""
+    millis = ulid_millis(value)
+    if millis > MAX_ULID_MILLIS:
+        raise ValueError(f"ULID timestamp out of range: {value}")
+    return datetime.datetime.fromtimestamp(millis / 1000, tz=datetime.timezone.utc)
+
+
+def ulid_shard(value):
+    """Shard directory name (UTC ``YYYYMM``) of the month a ULID was created in"""
+    return ulid_datetime(value).strftime("%Y%m")
@@ -0,0 +1,170 @@
+import os
+import json
+import copy
+import time
+import bisect
+import threading
+import traceback
+
+
+class StoryIndex:
+    """Process-level index of the stories directory, keyed by story id.
+
+    Records are loaded once and kept in memory together with an ordering by
+    (created_date, id) and a cached summary projection per record. Changes
+    made by other processes are picked up through mtime checks: the directory
+    mtime catches added/removed files and a per-file mtime check catches files
+    rewritten in place.
+    """
+
+    def __init__(self, stories_dir, rescan_interval=5.0, summarize=None):
+        self.stories_dir = stories_dir
+        self.rescan_interval = rescan_interval
+        self.summarize = summarize
+        self._lock = threading.RLock()
+        self._records = {}   # story id -> story data
+        self._summaries = {} # story id -> summary projection (built lazily)
+        self._mtimes = {}    # story id -> file mtime_ns when loaded
+        self._keys = []      # (created_date, id) tuples, oldest first
+        self._dir_mtime = None
+        self._last_scan = 0.0
+
+    def _story_path(self, story_id):
+        return os.path.join(self.stories_dir, f"{story_id}.json")
+
+    def _read_file(self, path):
+        """Read a single story file, returning None if it is missing or invalid"""
+        try:
+            with open(path, "r") as f:
+                story_data = json.load(f)
+            # Other JSON kept next to the stories (e.g. an old aliases.json) is not a story
+            return story_data if isinstance(story_data, dict) and "id" in story_data else None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error loading story file {path}: {e}")
+            traceback.print_exc()
+            return None
+
+    def _resort(self):
+        self._keys = sorted(
+            (story_data.get("created_date", ""), story_id)
+            for story_id, story_data in self._records.items()
+        )
+
+    def _set_record(self, story_id, story_data, mtime):
+        self._records[story_id] = story_data
+        self._summaries.pop(story_id, None)
+        self._mtimes[story_id] = mtime
+
+    def _drop_record(self, story_id):
+        del self._records[story_id]
+        self._summaries.pop(story_id, None)
+        self._mtimes.pop(story_id, None)
+
+    def _scan(self):
+        """Reconcile the index with the files currently on disk"""
+        try:
+            dir_mtime = os.stat(self.stories_dir).st_mtime_ns
+        except FileNotFoundError:
+            self._records, self._summaries, self._mtimes, self._keys = {}, {}, {}, []
+            self._dir_mtime = None
+            return
+
+        seen = set()
+        changed = False
+        with os.scandir(self.stories_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                story_id = entry.name[:-len(".json")]
+                seen.add(story_id)
+                mtime = entry.stat().st_mtime_ns
+                if self._mtimes.get(story_id) == mtime:
+                    continue
+                story_data = self._read_file(entry.path)
+                if story_data is None:
+                    continue
+                self._set_record(story_id, story_data, mtime)
+                changed = True
+
+        for story_id in list(self._records):
+            if story_id not in seen:
+                self._drop_record(story_id)
+                changed = True
+
+        if changed:
+            self._resort()
+        self._dir_mtime = dir_mtime
+        self._last_scan = time.monotonic()
+
+    def _refresh(self):
+        """Rescan when the directory changed or the rescan interval has passed"""
+        try:
+            dir_mtime = os.stat(self.stories_dir).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime = None
+        stale = time.monotonic() - self._last_scan >= self.rescan_interval
+        if dir_mtime != self._dir_mtime or stale:
+            self._scan()
+
+    def all(self):
+        """Return all stories, newest first.
+
+        The returned records are shared with the index and must not be mutated.
+        """
+        with self._lock:
+            self._refresh()
+            return [self._records[story_id] for _, story_id in reversed(self._keys)]
+
+    def page(self, limit, before=None):
+        """Return up to ``limit`` summaries older than the ``before`` key, newest first.
+
+        ``before`` is a (created_date, id) tuple taken from the last item of the
+        previous page. Returns (summaries, has_more).
+        """
+        with self._lock:
+            self._refresh()
+            end = len(self._keys) if before is None else bisect.bisect_left(self._keys, tuple(before))
+            start = max(end - limit, 0)
+            summaries = []
+            for _, story_id in reversed(self._keys[start:end]):
+                summary = self._summaries.get(story_id)
+                if summary is None:
+                    summary = self.summarize(self._records[story_id])
+                    self._summaries[story_id] = summary
+                summaries.append(summary)
+            return summaries, start > 0
+
+    def get(self, story_id):
+        """Return a copy of a single story, or None if it does not exist"""
+        path = self._story_path(story_id)
+        with self._lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except (FileNotFoundError, ValueError):
+                if story_id in self._records:
+                    self._drop_record(story_id)
+                    self._resort()
+                return None
+
+            if self._mtimes.get(story_id) != mtime:
+                story_data = self._read_file(path)
+                if story_data is None:
+                    return None
+                self._set_record(story_id, story_data, mtime)
+                self._resort()
+
+            return copy.deepcopy(self._records[story_id])
+
+    def put(self, story_data):
+        """Record a story that was just written to disk by this process"""
+        story_id = story_data["id"]
+        path = self._story_path(story_id)
+        with self._lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            self._set_record(story_id, copy.deepcopy(story_data), mtime)
+            self._resort()
@@ -0,0 +1,657 @@
+import os
+import re
+import json
+import time
+import base64
+import bisect
+import sqlite3
+import datetime
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+from markupsafe import Markup
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of this process
+    fcntl = None
+
+from story_index import StoryIndex
+from story_ids import is_ulid, new_ulid, ulid_shard
+
+EXCERPT_LENGTH = 100
+
+# Sharded layout: <stories_dir>/<YYYYMM>/<ulid>.json plus one manifest per shard
+MANIFEST_NAME = "manifest.jsonl"
+ALIASES_NAME = "aliases.json"
+# Kept out of the top level, which the flat json backend scans for stories
+META_DIR = ".meta"
+# Compact a manifest once it holds this many more lines than stories
+MANIFEST_COMPACT_SLACK = 1000
+SHARD_PATTERN = re.compile(r"^\d{6}$")
+
+
+def make_excerpt(markdown_story, length=EXCERPT_LENGTH):
+    """Build the card excerpt, matching the old ``striptags|truncate(100)`` output"""
+    if not markdown_story:
+        return ""
+    text = Markup(markdown_story).striptags()
+    # Same rules as Jinja's truncate filter (leeway of 5, break on a word)
+    if len(text) <= length + 5:
+        return text
+    return text[:length - 3].rsplit(" ", 1)[0] + "..."
+
+
+def story_summary(story_data):
+    """Project a story record down to the fields the story listing needs"""
+    excerpt = story_data.get("excerpt")
+    if excerpt is None:
+        excerpt = make_excerpt(story_data.get("markdown_story", ""))
+    return {
+        "id": story_data["id"],
+        "title": story_data.get("title"),
+        "created_date": story_data.get("created_date", ""),
+        "excerpt": excerpt,
+        "thumbnail": story_data.get("thumbnail"),
+    }
+
+
+def encode_cursor(summary):
+    """Encode the keyset position after ``summary`` as an opaque cursor"""
+    raw = json.dumps([summary["created_date"], summary["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into a (created_date, id) tuple; raises ValueError if malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_date, story_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if not isinstance(created_date, str) or not isinstance(story_id, str):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return created_date, story_id
+
+
+def write_json_atomic(path, data):
+    """Write JSON through a temp file and rename, so readers never see a partial record"""
+    write_text_atomic(path, json.dumps(data, indent=2))
+
+
+def write_text_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class StoryLocks:
+    """Per-story locks for read-modify-write updates.
+
+    A thread lock per story serializes writers in this process. With a
+    ``lock_dir`` and fcntl available, an exclusive flock on a per-story lock
+    file extends that to other worker processes. Thread locks are dropped
+    once nobody holds or waits for them, and lock files are removed by the
+    holder on release, so neither builds up one per story ever updated.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir if fcntl else None
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self._guard = threading.Lock()
+        self._locks = {}  # story id -> [lock, number of holders and waiters]
+
+    def _lock_file(self, story_id):
+        """Open and flock the story's lock file, retrying if it was removed while we waited"""
+        path = os.path.join(self.lock_dir, f"{story_id}.lock")
+        while True:
+            f = open(path, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f, path
+            except FileNotFoundError:
+                pass
+            # The previous holder removed this file; lock the one at the path now
+            f.close()
+
+    @contextmanager
+    def hold(self, story_id):
+        with self._guard:
+            entry = self._locks.setdefault(story_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if self.lock_dir:
+                    f, path = self._lock_file(story_id)
+                    try:
+                        yield
+                    finally:
+                        # Removed while still locked, so waiters on it notice and retry
+                        os.unlink(path)
+                        f.close()
+                else:
+                    yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[story_id]
+
+
+class JsonStoryStore:
+    """Story store backed by one JSON file per story in a directory.
+
+    Suitable for small installs; reads go through an in-memory StoryIndex.
+    """
+
+    backend = "json"
+
+    def __init__(self, stories_dir, rescan_interval=5.0):
+        self.stories_dir = stories_dir
+        os.makedirs(stories_dir, exist_ok=True)
+        self.index = StoryIndex(stories_dir, rescan_interval=rescan_interval, summarize=story_summary)
+        self.locks = StoryLocks(os.path.join(stories_dir, ".locks"))
+
+    def _story_path(self, story_id):
+        return os.path.join(self.stories_dir, f"{story_id}.json")
+
+    def get(self, story_id):
+        """Return a single story by ID, or None"""
+        return self.index.get(story_id)
+
+    def list_all(self):
+        """Return all stories, newest first"""
+        return self.index.all()
+
+    def list_summaries(self, limit, cursor=None):
+        """Return (summaries, next_cursor) for one page of the newest-first listing"""
+        before = decode_cursor(cursor) if cursor else None
+        summaries, has_more = self.index.page(limit, before)
+        next_cursor = encode_cursor(summaries[-1]) if has_more and summaries else None
+        return summaries, next_cursor
+
+    def _write(self, story_data):
+        write_json_atomic(self._story_path(story_data["id"]), story_data)
+        self.index.put(story_data)
+
+    def save(self, story_data):
+        """Insert or replace a story"""
+        with self.locks.hold(story_data["id"]):
+            self._write(story_data)
+        return story_data
+
+    def update(self, story_id, fn):
+        """Read-modify-write one story under its lock.
+
+        ``fn`` gets the current record and returns the record to save, or None
+        to leave it unchanged. Returns the saved record, or None if the story
+        does not exist or ``fn`` declined. Keep ``fn`` short: slow work such as
+        model calls belongs before the update.
+        """
+        with self.locks.hold(story_id):
+            story_data = self.index.get(story_id)
+            if story_data is None:
+                return None
+            story_data = fn(story_data)
+            if story_data is not None:
+                self._write(story_data)
+            return story_data
+
+
+class ShardManifest:
+    """Summaries of one shard, read incrementally from its append-only manifest.
+
+    Every save appends the record's summary as one JSON line and the last
+    line for an id wins, so only bytes appended since the previous read need
+    parsing. Compaction replaces the file with one line per story.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._inode = None
+        self._offset = 0
+        self.lines = 0
+        self._summaries = {}  # story id -> latest summary
+        self._keys = []       # (created_date, id) tuples, oldest first
+
+    @property
+    def superseded(self):
+        """Lines that a later line for the same story has replaced"""
+        return self.lines - len(self._summaries)
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+            size, inode = stat.st_size, stat.st_ino
+        except FileNotFoundError:
+            size, inode = 0, None
+        if inode != self._inode or size < self._offset:
+            # Replaced (compacted or rebuilt) rather than appended to; read it again
+            self._inode = inode
+            self._offset, self.lines, self._summaries, self._keys = 0, 0, {}, []
+        if size == self._offset:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read(size - self._offset)
+        # A concurrent append may not have finished its last line yet
+        end = chunk.rfind(b"\n") + 1
+        if end == 0:
+            return
+        for line in chunk[:end].splitlines():
+            self.lines += 1
+            try:
+                summary = json.loads(line)
+                self._summaries[summary["id"]] = summary
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Error reading manifest line in {self.path}: {e}")
+        self._offset += end
+        self._keys = sorted(
+            (summary.get("created_date", ""), story_id)
+            for story_id, summary in self._summaries.items()
+        )
+
+    def page(self, limit, before=None):
+        """Return up to ``limit`` summaries older than the ``before`` key, newest first"""
+        end = len(self._keys) if before is None else bisect.bisect_left(self._keys, tuple(before))
+        return [self._summaries[story_id] for _, story_id in reversed(self._keys[max(end - limit, 0):end])]
+
+    def ids(self):
+        """IDs of every story in the shard, newest first"""
+        return [story_id for _, story_id in reversed(self._keys)]
+
+    def summaries(self):
+        """Latest summary of every story in the shard, oldest first"""
+        return [self._summaries[story_id] for _, story_id in self._keys]
+
+
+class ShardedJsonStoryStore:
+    """Story store with one JSON file per story, sharded by creation month.
+
+    Stories live at ``<stories_dir>/<YYYYMM>/<ulid>.json``. The shard is the
+    UTC month encoded in the ULID, so finding a story by id needs no index.
+    Newest-first listing reads the manifests of the newest shards and stops
+    once the page is full, instead of listing and sorting every file. A
+    manifest is compacted once superseded lines pile up. Stories moved in
+    from the flat layout still answer to their old ids through
+    ``.meta/aliases.json``.
+    """
+
+    backend = "sharded"
+
+    def __init__(self, stories_dir):
+        self.stories_dir = stories_dir
+        os.makedirs(stories_dir, exist_ok=True)
+        self.locks = StoryLocks(os.path.join(stories_dir, ".locks"))
+        self._lock = threading.Lock()
+        self._manifests = {}  # shard name -> ShardManifest
+        self._aliases = {}    # old flat-layout id -> ULID
+        self._aliases_mtime = None
+
+    def _story_path(self, story_id):
+        return os.path.join(self.stories_dir, ulid_shard(story_id), f"{story_id}.json")
+
+    def _load_aliases(self):
+        """Return the alias map, re-reading aliases.json if it changed (caller holds the lock)"""
+        path = os.path.join(self.stories_dir, META_DIR, ALIASES_NAME)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._aliases, self._aliases_mtime = {}, None
+            return self._aliases
+        if mtime != self._aliases_mtime:
+            with open(path, "r") as f:
+                self._aliases = json.load(f)
+            self._aliases_mtime = mtime
+        return self._aliases
+
+    def resolve(self, story_id):
+        """Return the ULID a story id refers to, or None if it is unknown"""
+        if is_ulid(story_id):
+            return story_id
+        with self._lock:
+            return self._load_aliases().get(story_id)
+
+    def _read(self, story_id):
+        try:
+            with open(self._story_path(story_id), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OverflowError):
+            # Also an id whose timestamp names no shard
+            return None
+
+    def get(self, story_id):
+        """Return a single story by ID (or old flat-layout ID), or None"""
+        story_id = self.resolve(story_id)
+        return self._read(story_id) if story_id else None
+
+    def _shards(self):
+        """Shard directory names, newest first"""
+        with os.scandir(self.stories_dir) as entries:
+            names = [entry.name for entry in entries if entry.is_dir() and SHARD_PATTERN.match(entry.name)]
+        return sorted(names, reverse=True)
+
+    def _manifest(self, shard):
+        """Up-to-date manifest of one shard, compacted if needed (caller holds the lock)"""
+        manifest = self._manifests.get(shard)
+        if manifest is None:
+            manifest = ShardManifest(os.path.join(self.stories_dir, shard, MANIFEST_NAME))
+            self._manifests[shard] = manifest
+        manifest.refresh()
+        if manifest.superseded > max(MANIFEST_COMPACT_SLACK, len(manifest.ids())):
+            with self.locks.hold(f"shard-{shard}"):
+                # Appends take the shard lock too, so none can be lost in between
+                manifest.refresh()
+                self._write_manifest(shard, manifest.summaries())
+            manifest.refresh()
+        return manifest
+
+    def _write_manifest(self, shard, summaries):
+        """Replace a shard's manifest with one line per story (caller holds the shard lock)"""
+        lines = "".join(json.dumps(summary) + "\n" for summary in summaries)
+        write_text_atomic(os.path.join(self.stories_dir, shard, MANIFEST_NAME), lines)
+
+    def rebuild_manifest(self, shard):
+        """Rebuild a shard's manifest from its story files, dropping superseded lines"""
+        shard_dir = os.path.join(self.stories_dir, shard)
+        with self.locks.hold(f"shard-{shard}"):
+            summaries = []
+            for filename in sorted(os.listdir(shard_dir)):
+                if filename.endswith(".json") and is_ulid(filename[:-len(".json")]):
+                    story_data = self._read(filename[:-len(".json")])
+                    if story_data is not None:
+                        summaries.append(story_summary(story_data))
+            self._write_manifest(shard, summaries)
+        return len(summaries)
+
+    def list_all(self):
+        """Return all stories, newest first"""
+        with self._lock:
+            story_ids = [story_id for shard in self._shards() for story_id in self._manifest(shard).ids()]
+        stories = (self._read(story_id) for story_id in story_ids)
+        return [story_data for story_data in stories if story_data is not None]
+
+    def list_summaries(self, limit, cursor=None):
+        """Return (summaries, next_cursor) for one page of the newest-first listing"""
+        before = decode_cursor(cursor) if cursor else None
+        summaries = []
+        with self._lock:
+            for shard in self._shards():
+                summaries.extend(self._manifest(shard).page(limit + 1 - len(summaries), before))
+                if len(summaries) > limit:
+                    break
+        next_cursor = encode_cursor(summaries[limit - 1]) if len(summaries) > limit else None
+        return summaries[:limit], next_cursor
+
+    def _write(self, story_data):
+        story_id = story_data["id"]
+        if not is_ulid(story_id):
+            raise ValueError(f"Sharded story ids must be ULIDs: {story_id!r}")
+        path = self._story_path(story_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, story_data)
+        # The shard lock keeps appends out of the way of compaction
+        with self.locks.hold(f"shard-{ulid_shard(story_id)}"):
+            with open(os.path.join(os.path.dirname(path), MANIFEST_NAME), "a") as f:
+                f.write(json.dumps(story_summary(story_data)) + "\n")
+
+    def save(self, story_data):
+        """Insert or replace a story"""
+        with self.locks.hold(story_data["id"]):
+            self._write(story_data)
+        return story_data
+
+    def update(self, story_id, fn):
+        """Read-modify-write one story under its lock; see JsonStoryStore.update"""
+        story_id = self.resolve(story_id)
+        if story_id is None:
+            return None
+        with self.locks.hold(story_id):
+            story_data = self._read(story_id)
+            if story_data is None:
+                return None
+            story_data = fn(story_data)
+            if story_data is not None:
+                self._write(story_data)
+            return story_data
+
+    def import_flat_dir(self, source_dir, remove=True):
+        """Move stories from the flat layout (``<source_dir>/<id>.json``) into shards.
+
+        Each story gets a ULID carrying its created_date, and its old id is
+        kept in ``legacy_id`` and in .meta/aliases.json so old URLs keep
+        working. Safe to run again: stories already moved keep their ULID, and
+        the manifests of the shards written to are rebuilt without duplicate
+        lines. Returns (moved, skipped) counts.
+        """
+        with self._lock:
+            aliases = dict(self._load_aliases())
+        moved = skipped = 0
+        sources, shards = [], []
+        for filename in sorted(os.listdir(source_dir)):
+            path = os.path.join(source_dir, filename)
+            if not filename.endswith(".json") or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r") as f:
+                    story_data = json.load(f)
+            except Exception as e:
+                print(f"Error reading {path}: {e}")
+                traceback.print_exc()
+                skipped += 1
+                continue
+
+            old_id = story_data.get("id") or filename[:-len(".json")]
+            if is_ulid(old_id):
+                new_id = old_id
+            else:
+                new_id = aliases.get(old_id) or new_ulid(_created_timestamp(story_data, path))
+                aliases[old_id] = new_id
+                story_data["legacy_id"] = old_id
+            story_data["id"] = new_id
+            self.save(story_data)
+            shards.append(ulid_shard(new_id))
+            sources.append(path)
+            moved += 1
+
+        # Aliases are in place before the old files go away
+        meta_dir = os.path.join(self.stories_dir, META_DIR)
+        os.makedirs(meta_dir, exist_ok=True)
+        write_json_atomic(os.path.join(meta_dir, ALIASES_NAME), aliases)
+        for shard in sorted(set(shards)):
+            self.rebuild_manifest(shard)
+        if remove:
+            for path in sources:
+                os.remove(path)
+        return moved, skipped
+
+
+def _created_timestamp(story_data, path):
+    """Creation time of a story in seconds: its created_date (local time), else the file mtime"""
+    try:
+        created = datetime.datetime.strptime(story_data.get("created_date", ""), "%Y-%m-%d %H:%M:%S")
+        return time.mktime(created.timetuple())
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+class SqliteStoryStore:
+    """Story store backed by a SQLite database in WAL mode.
+
+    The full story_data dict is kept as JSON in the ``data`` column so records
+    keep exactly the shape the templates consume; ``id`` and ``created_date``
+    are mirrored into indexed columns for lookups and ordering.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stories (
+                    id TEXT PRIMARY KEY,
+                    created_date TEXT NOT NULL DEFAULT '',
+                    title TEXT,
+                    excerpt TEXT,
+                    data TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_stories_created_date "
+                "ON stories (created_date DESC, id DESC)"
+            )
+
+            # Databases created before summaries were projected lack the excerpt column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(stories)")]
+            if "excerpt" not in columns:
+                conn.execute("ALTER TABLE stories ADD COLUMN excerpt TEXT")
+            rows = conn.execute("SELECT id, data FROM stories WHERE excerpt IS NULL").fetchall()
+            for story_id, data in rows:
+                conn.execute(
+                    "UPDATE stories SET excerpt = ? WHERE id = ?",
+                    (story_summary(json.loads(data))["excerpt"], story_id)
+                )
+
+    def _row_values(self, story_data):
+        return (
+            story_data["id"],
+            story_data.get("created_date", ""),
+            story_data.get("title"),
+            story_summary(story_data)["excerpt"],
+            json.dumps(story_data),
+        )
+
+    def get(self, story_id):
+        """Return a single story by ID, or None"""
+        row = self._connect().execute(
+            "SELECT data FROM stories WHERE id = ?", (story_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_all(self):
+        """Return all stories, newest first"""
+        rows = self._connect().execute(
+            "SELECT data FROM stories ORDER BY created_date DESC, id DESC"
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_summaries(self, limit, cursor=None):
+        """Return (summaries, next_cursor) for one page of the newest-first listing"""
+        query = "SELECT id, title, created_date, excerpt, json_extract(data, '$.thumbnail') FROM stories"
+        params = []
+        if cursor:
+            query += " WHERE (created_date, id) < (?, ?)"
+            params.extend(decode_cursor(cursor))
+        query += " ORDER BY created_date DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        rows = self._connect().execute(query, params).fetchall()
+        summaries = [
+            {"id": row[0], "title": row[1], "created_date": row[2], "excerpt": row[3] or "", "thumbnail": row[4]}
+            for row in rows[:limit]
+        ]
+        next_cursor = encode_cursor(summaries[-1]) if len(rows) > limit else None
+        return summaries, next_cursor
+
+    def save(self, story_data):
+        """Insert or replace a story"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stories (id, created_date, title, excerpt, data) VALUES (?, ?, ?, ?, ?)",
+                self._row_values(story_data)
+            )
+        return story_data
+
+    def update(self, story_id, fn):
+        """Read-modify-write one story inside a write transaction; see JsonStoryStore.update"""
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front, so two updates cannot both read the old row
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM stories WHERE id = ?", (story_id,)).fetchone()
+            story_data = fn(json.loads(row[0])) if row else None
+            if story_data is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                "INSERT OR REPLACE INTO stories (id, created_date, title, excerpt, data) VALUES (?, ?, ?, ?, ?)",
+                self._row_values(story_data)
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return story_data
+
+    def import_json_dir(self, stories_dir, overwrite=False):
+        """Import stories/*.json files, returning (imported, skipped) counts"""
+        imported = skipped = 0
+        conn = self._connect()
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with conn:
+            for filename in sorted(os.listdir(stories_dir)):
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(stories_dir, filename)
+                try:
+                    with open(path, "r") as f:
+                        story_data = json.load(f)
+                    story_data.setdefault("id", filename[:-len(".json")])
+                except Exception as e:
+                    print(f"Error reading {path}: {e}")
+                    traceback.print_exc()
+                    skipped += 1
+                    continue
+                cursor = conn.execute(
+                    f"{verb} INTO stories (id, created_date, title, excerpt, data) VALUES (?, ?, ?, ?, ?)",
+                    self._row_values(story_data)
+                )
+                if cursor.rowcount:
+                    imported += 1
+                else:
+                    skipped += 1
+        return imported, skipped
+
+
+def create_story_store(backend, stories_dir, db_path, rescan_interval=5.0):
+    """Create the configured story store ("json", "sharded" or "sqlite")"""
+    backend = (backend or "json").lower()
+    if backend == "sqlite":
+        return SqliteStoryStore(db_path)
+    if backend == "sharded":
+        return ShardedJsonStoryStore(stories_dir)
+    if backend != "json":
+        raise ValueError(f"Unknown story store backend: {backend}")
+    return JsonStoryStore(stories_dir, rescan_interval=rescan_interval)
@@ -0,0 +1,88 @@
+import json
+import markdown
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class StoryStreamParser:
+    """Incrementally split streamed story markdown into title, intro and panels.
+
+    Feed text chunks as they arrive; each call returns the (event, data) pairs
+    that became complete. A section is complete once the next heading starts,
+    so the intro is emitted when ``## Panel 1`` arrives and each panel when the
+    following heading (or the end of the stream) arrives. Anything from the
+    ``## Image Prompts`` heading onwards is ignored.
+    """
+
+    def __init__(self):
+        self._pending = ""       # partial line not yet terminated by a newline
+        self._title = None
+        self._intro = []
+        self._panel = None       # (heading, lines) for the panel being collected
+        self._panel_count = 0
+        self._in_panels = False
+        self._finished = False
+
+    def feed(self, text):
+        """Consume a chunk of streamed text and return completed events"""
+        if self._finished:
+            return []
+        self._pending += text
+        *lines, self._pending = self._pending.split("\n")
+        events = []
+        for line in lines:
+            events.extend(self._consume_line(line))
+            if self._finished:
+                break
+        return events
+
+    def close(self):
+        """Flush whatever is left at the end of the stream"""
+        events = []
+        if not self._finished and self._pending:
+            events.extend(self._consume_line(self._pending))
+        self._pending = ""
+        if not self._finished:
+            events.extend(self._finish())
+        return events
+
+    def _consume_line(self, line):
+        if line.startswith("## Image Prompts"):
+            return self._finish()
+        if line.startswith("# ") and self._title is None:
+            self._title = line[2:].strip()
+            return [("title", {"title": self._title})]
+        if line.startswith("## "):
+            events = self._flush_section()
+            self._panel = (line[3:].strip(), [])
+            self._in_panels = True
+            return events
+        if self._panel is not None:
+            self._panel[1].append(line)
+        elif not self._in_panels:
+            self._intro.append(line)
+        return []
+
+    def _flush_section(self):
+        """Emit the intro (before the first panel) or the panel just completed"""
+        if self._panel is None:
+            if self._in_panels:
+                return []
+            intro = "\n".join(self._intro).strip()
+            return [("intro", {"html": markdown.markdown(intro)})] if intro else []
+
+        heading, lines = self._panel
+        self._panel = None
+        self._panel_count += 1
+        return [("panel", {
+            "number": self._panel_count,
+            "title": heading,
+            "html": markdown.markdown("\n".join(lines).strip())
+        })]
+
+    def _finish(self):
+        self._finished = True
+        return self._flush_section()
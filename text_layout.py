@@ -0,0 +1,119 @@
+import os
+import hashlib
+from functools import lru_cache
+import PIL
+from PIL import ImageFont
+
+# Fonts tried in order when no font path is configured
+FONT_SEARCH_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+    "/Library/Fonts/Arial Bold.ttf",
+    "C:\\Windows\\Fonts\\arialbd.ttf",
+]
+
+ELLIPSIS = "..."
+
+
+def find_font_path(candidates=FONT_SEARCH_PATHS):
+    """Return the first font file that exists, or None"""
+    return next((path for path in candidates if os.path.isfile(path)), None)
+
+
+def font_fingerprint(path):
+    """Short hash of the font text is drawn with: the file's bytes, or Pillow's version for its built-in font"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                digest.update(block)
+    except (TypeError, OSError):
+        digest.update(f"pillow-{PIL.__version__}".encode("utf-8"))
+    return digest.hexdigest()[:8]
+
+
+@lru_cache(maxsize=32)
+def load_font(path, size):
+    """Load a TrueType font once per (path, size).
+
+    Falls back to Pillow's built-in font (scalable on Pillow 10.1+) when the
+    path is missing or cannot be read.
+    """
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError as e:
+            print(f"Error loading font {path}: {e}")
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def text_width(font, text):
+    """Rendered width of a single line of text in pixels"""
+    left, _, right, _ = font.getbbox(text)
+    return right - left
+
+
+def line_height(font):
+    """Distance between baselines for consecutive lines"""
+    if hasattr(font, "getmetrics"):
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    _, top, _, bottom = font.getbbox("Ag")
+    return bottom - top
+
+
+def _break_word(word, font, max_width):
+    """Split a word that is wider than max_width into pieces that fit"""
+    pieces = []
+    piece = ""
+    for char in word:
+        if piece and text_width(font, piece + char) > max_width:
+            pieces.append(piece)
+            piece = char
+        else:
+            piece += char
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+@lru_cache(maxsize=4096)
+def wrap_text(text, font, max_width):
+    """Greedily wrap text into lines no wider than max_width.
+
+    Returns a tuple of lines. Results are memoized per (text, font, max_width);
+    fonts come from load_font, so the same font object is reused as the key.
+    """
+    lines = []
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if text_width(font, candidate) <= max_width:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        if text_width(font, word) <= max_width:
+            line = word
+        else:
+            *full, line = _break_word(word, font, max_width)
+            lines.extend(full)
+    if line:
+        lines.append(line)
+    return tuple(lines)
+
+
+def fit_text(text, font, max_width, max_lines):
+    """Wrap text and cut it to max_lines, ending the last line with an ellipsis"""
+    lines = wrap_text(text, font, max_width)
+    if len(lines) <= max_lines:
+        return lines
+
+    last = lines[max_lines - 1]
+    while last and text_width(font, last + ELLIPSIS) > max_width:
+        last = last[:-1]
+    return lines[:max_lines - 1] + (last.rstrip() + ELLIPSIS,)